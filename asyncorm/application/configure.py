@@ -57,6 +57,10 @@ class OrmApp(object):
 
         self.models_configure()
 
+        self.db_manager.warm_up_queries = [
+            query for model in self.models.values() for query in model.objects.warm_up_queries()
+        ]
+
     def _get_declared_apps(self, app_names):
         _apps = {}
         app_names.append('asyncorm.migrations')
@@ -109,13 +113,11 @@ class OrmApp(object):
             vvv = model.fields.items()
             for k, f in vvv:
                 if isinstance(f, ManyToManyField):
-                    m2m_tablename = '{}_{}'.format(model.table_name, k).lower()
-                    db_column = '{}_{}'.format(name, model.db_pk).lower()
-
+                    # the through table has a column named after each of the models
                     other = self.get_model(f.foreign_key)
-                    other.set_many2many(f, m2m_tablename, f.foreign_key, name)
+                    other.set_many2many(f, f.table_name, f.foreign_key, f.own_model, name)
 
-                    model.set_many2many(f, m2m_tablename, db_column, f.foreign_key)
+                    model.set_many2many(f, f.table_name, f.own_model, f.foreign_key, f.foreign_key)
 
                 elif isinstance(f, ForeignKey):
                     other_model = self.get_model(f.foreign_key)
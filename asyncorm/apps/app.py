@@ -158,10 +158,10 @@ class AppMigration:
             'table_name': 'asyncorm_migrations',
             'join': '',
             'ordering': 'ORDER BY -id',
-            'condition': "app_name = '{}'".format(self.name),
+            'condition': 'app_name = $1',
         }
 
-        result = await self.db_manager.request(self.db_manager.db__select.format(**kwargs))
+        result = await self.db_manager.request((self.db_manager.db__select.format(**kwargs), [self.name]))
         return result and result['name'] or ''
 
     async def check_migration_applied(self, migration_name):
@@ -170,9 +170,10 @@ class AppMigration:
             'table_name': 'asyncorm_migrations',
             'join': '',
             'ordering': '',
-            'condition': "app_name = '{}' AND name = '{}'".format(self.name, migration_name),
+            'condition': 'app_name = $1 AND name = $2',
         }
-        result = await self.db_manager.request(self.db_manager.db__select.format(**kwargs))
+        result = await self.db_manager.request(
+            (self.db_manager.db__select.format(**kwargs), [self.name, migration_name]))
         return result
 
     def fs_migration_list(self):
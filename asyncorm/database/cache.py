@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Bounded mapping that drops the least recently used entries
+    hits, misses and evictions are counted in stats, that can be shared between caches
+    '''
+
+    def __init__(self, maxsize=128, stats=None):
+        self.maxsize = maxsize
+        self.stats = stats if stats is not None else {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.stats['misses'] += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def cache_info(stats):
+    '''the stats counters plus the hit rate'''
+    info = dict(stats)
+    lookups = info['hits'] + info['misses']
+    info['hit_rate'] = lookups and info['hits'] / lookups or 0.0
+    return info
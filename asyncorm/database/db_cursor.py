@@ -1,53 +1,152 @@
+import asyncio
+import sys
+from collections import deque
+
+
+def record_size(record):
+    '''rough estimation of the memory taken by the values of a record'''
+    return sum(sys.getsizeof(v) for v in record.values())
+
+
 class Cursor(object):
+    '''
+    Server side cursor that keeps the same connection and transaction
+    for the whole iteration, the connection goes back to the pool once
+    the results are exhausted or the cursor is explicitly closed
+
+    When max_step is bigger than step the page size grows geometrically
+    until that cap, as long as the pages stay under page_bytes and are
+    fetched faster than page_latency. With prefetch the next page is
+    requested while the current one is still being consumed.
+    '''
+    page_bytes = 4 * 1024 * 1024
+    page_latency = 0.5
+    growth = 2
 
-    def __init__(self, pool, query, values=None, step=20, forward=0, stop=None):
+    def __init__(self, pool, query, values=None, step=20, max_step=None,
+                 prefetch=False, prepare=None):
         self._pool = pool
+        self._prepare = prepare
         self._query = query
-        self._values = values
+        self._values = values or []
+        self._loop = None
+        self._conn = None
+        self._transaction = None
         self._cursor = None
-        self._results = []
+        self._results = deque()
+        self._prefetched = None
 
         self._step = step
-        self._forward = forward
-        self._stop = stop
-        self._iddle = True
+        self._min_step = step
+        self._max_step = max(max_step or step, step)
+        self._prefetch = prefetch
+        self._drained = False
+        self._exhausted = False
 
-    async def get_results(self):
-        self._iddle = False
-        async with self._pool.acquire() as conn:
-            async with conn.transaction():
-                if self._values:
-                    self._cursor = await conn.cursor(self._query, self._values)
+        self.stats = {'pages': 0, 'rows': 0, 'bytes': 0}
+
+    async def open(self):
+        self._loop = asyncio.get_event_loop()
+        self._conn = await self._pool.acquire()
+        try:
+            query = self._query
+            if self._prepare is not None:
+                # before the transaction starts, so a failure there does not abort it
+                query = await self._prepare(self._conn, query)
+
+            self._transaction = self._conn.transaction()
+            await self._transaction.start()
+
+            self._cursor = await self._conn.cursor(query, *self._values)
+        except Exception:
+            await self.aclose(rollback=True)
+            raise
+
+    async def aclose(self, rollback=False):
+        self._exhausted = True
+        self._results.clear()
+        if self._conn is None:
+            return
+
+        # a page still on its way has to land before the connection is released
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is not None:
+            try:
+                await prefetched
+            except Exception:
+                rollback = True
+
+        conn, transaction = self._conn, self._transaction
+        self._conn, self._transaction, self._cursor = None, None, None
+        try:
+            if transaction is not None:
+                if rollback:
+                    await transaction.rollback()
                 else:
-                    self._cursor = await conn.cursor(self._query)
+                    await transaction.commit()
+        finally:
+            await self._pool.release(conn)
 
-                if self._forward:
-                    await self._cursor.forward(self._forward)
+    def _adapt_step(self, results, elapsed):
+        row_size = record_size(results[0])
 
-                no_stop = self._stop is not None
-                if no_stop and self._forward >= self._stop:
-                    raise StopAsyncIteration()
-                if no_stop and self._forward + self._step >= self._stop:
-                    self._step = self._stop - self._forward
+        self.stats['pages'] += 1
+        self.stats['rows'] += len(results)
+        self.stats['bytes'] += row_size * len(results)
 
-                results = await self._cursor.fetch(self._step)
+        if self._max_step == self._min_step:
+            return
+        if elapsed > self.page_latency:
+            self._step = max(self._step // self.growth, self._min_step)
+        else:
+            by_size = max(self.page_bytes // max(row_size, 1), self._min_step)
+            self._step = min(self._step * self.growth, self._max_step, by_size)
 
-                if not results:
-                    raise StopAsyncIteration()
-        self._iddle = True
+    async def get_results(self):
+        step = self._step
+        start = self._loop.time()
+        results = await self._cursor.fetch(step)
+        # a short page means there is nothing else to fetch
+        self._drained = len(results) < step
+
+        if results:
+            self._adapt_step(results, self._loop.time() - start)
         return results
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        if self._cursor is None:
-            self._results = await self.get_results()
-
         if not self._results:
-            self._forward = self._forward + self._step
-            if self._stop is not None and self._forward > self._stop:
-                self._forward = self._stop
-            self._results = await self.get_results()
+            if self._exhausted:
+                raise StopAsyncIteration()
+            if self._drained and self._prefetched is None:
+                await self.aclose()
+                raise StopAsyncIteration()
+            if self._cursor is None:
+                await self.open()
+
+            try:
+                if self._prefetched is not None:
+                    prefetched, self._prefetched = self._prefetched, None
+                    results = await prefetched
+                else:
+                    results = await self.get_results()
+            except Exception:
+                await self.aclose(rollback=True)
+                raise
+
+            if not results:
+                await self.aclose()
+                raise StopAsyncIteration()
+
+            self._results.extend(results)
+            if self._prefetch and not self._drained:
+                self._prefetched = self._loop.create_task(self.get_results())
+
+        return self._results.popleft()
 
-        return self._results.pop(0)
+    def __del__(self):
+        # the iteration was abandoned halfway, the connection has to go back to the pool
+        if self._conn is not None and self._loop is not None and not self._loop.is_closed():
+            self._loop.create_task(self._pool.release(self._conn))
@@ -1,8 +1,41 @@
+import json
+import re
+import weakref
+
 import asyncpg
+from asyncorm.database.cache import LRUCache, cache_info
 from asyncorm.log import logger
 
+PLACEHOLDER = re.compile(r'\$(\d+)')
+
+
+def freeze(value):
+    '''hashable version of the (nested) lists and dicts that make a query chain'''
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
 
 class GeneralManager(object):
+    # values are bound as $n parameters, so they are not part of the compiled sql
+    value_keys = ('values', 'field_values')
+    # the statement each action becomes once a where condition is chained
+    filtered_actions = {
+        'db__select_all': 'db__select',
+        'db__update_all': 'db__update_filtered',
+        'db__delete_all': 'db__delete_filtered',
+    }
+    compiled_cache_size = 512
+
+    def __init__(self):
+        self.compiled_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._compiled = LRUCache(self.compiled_cache_size, self.compiled_stats)
+
+    @property
+    def compiled_cache_stats(self):
+        return cache_info(self.compiled_stats)
 
     @property
     def db__create_table(self):
@@ -32,37 +65,86 @@ class GeneralManager(object):
     def db__insert(self):
         return 'INSERT INTO {table_name} ({field_names}) VALUES ({field_schema}) RETURNING * '
 
+    @property
+    def db__insert_many(self):
+        return 'INSERT INTO {table_name} ({field_names}) VALUES {field_schema} RETURNING * '
+
+    @property
+    def db__get_or_insert(self):
+        # the insert only runs when nothing matches, a concurrent one makes it do nothing
+        return '''
+            WITH existing AS (
+                SELECT * FROM {table_name} WHERE ( {condition} ) LIMIT 1
+            ), inserted AS (
+                INSERT INTO {table_name} ({field_names})
+                SELECT {field_schema} WHERE NOT EXISTS (SELECT 1 FROM existing)
+                ON CONFLICT DO NOTHING
+                RETURNING *
+            )
+            SELECT *, false AS _created FROM existing
+            UNION ALL
+            SELECT *, true AS _created FROM inserted
+        '''
+
+    @property
+    def db__upsert(self):
+        # xmax is only 0 in the rows that were inserted
+        return '''
+            INSERT INTO {table_name} ({field_names}) VALUES ({field_schema})
+            ON CONFLICT ({conflict_fields}) DO UPDATE SET {update_schema}
+            RETURNING *, (xmax = 0) AS _created
+        '''
+
+    @property
+    def db__upsert_many(self):
+        return '''
+            INSERT INTO {table_name} ({field_names}) VALUES {field_schema}
+            ON CONFLICT ({conflict_fields}) {conflict_action}
+            RETURNING *
+        '''
+
     @property
     def db__select_all(self):
         return 'SELECT {select} FROM {table_name} {join} {ordering}'
 
+    @property
+    def db__select_sliced(self):
+        # named as the table, so the columns qualified with it still work
+        return 'SELECT {select} FROM ({subquery}) AS {table_name}'
+
     @property
     def db__select_related(self):
-        # LEFT JOIN inventory ON inventory.film_id = film.film_id;
-        return 'LEFT JOIN {right_table} ON {foreign_field} = {right_table}.{model_db_pk} '
+        # LEFT JOIN inventory AS j1 ON j1.film_id = film.film_id;
+        return 'LEFT JOIN {right_table} AS {alias} ON {alias}.{model_db_pk} = {left_table}.{foreign_field} '
 
     @property
     def db__select(self):
         return self.db__select_all.replace('{ordering}', 'WHERE ( {condition} ) {ordering}')
 
-    @property
-    def db__exists(self):
-        return 'SELECT EXISTS({})'.format(self.db__select)
-
     @property
     def db__where(self):
         '''chainable'''
         return 'WHERE {condition} '
 
     @property
-    def db__select_m2m(self):
+    def db__m2m_select(self):
+        return 'SELECT {other_column} FROM {m2m_tablename} WHERE {my_column} = $1'
+
+    @property
+    def db__m2m_add(self):
         return '''
-            SELECT {select} FROM {other_tablename}
-            WHERE {otherdb_pk} = ANY (
-                SELECT {other_column_pk} FROM {m2m_tablename} WHERE {id_data}
-            ) {ordering}
+            INSERT INTO {m2m_tablename} ({my_column}, {other_column})
+            SELECT $1, other_id FROM unnest($2::integer[]) AS other_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {m2m_tablename} WHERE {my_column} = $1 AND {other_column} = other_id
+            )
+            ON CONFLICT DO NOTHING
         '''
 
+    @property
+    def db__m2m_remove(self):
+        return 'DELETE FROM {m2m_tablename} WHERE {my_column} = $1 AND {other_column} = ANY ($2::integer[])'
+
     @property
     def db__update(self):
         return '''
@@ -72,10 +154,36 @@ class GeneralManager(object):
             RETURNING *
         '''
 
+    @property
+    def db__update_many(self):
+        return '''
+            UPDATE ONLY {table_name}
+            SET {field_schema}
+            FROM unnest({unnest_schema}) AS bulk_data ({field_names})
+            WHERE {table_name}.{db_pk} = bulk_data.{db_pk}
+            RETURNING {table_name}.*
+        '''
+
+    @property
+    def db__update_all(self):
+        return 'UPDATE ONLY {table_name} SET {field_schema} {returning}'
+
+    @property
+    def db__update_filtered(self):
+        return self.db__update_all.replace('{returning}', 'WHERE ( {condition} ) {returning}')
+
     @property
     def db__delete(self):
         return 'DELETE FROM {table_name} WHERE {id_data} '
 
+    @property
+    def db__delete_all(self):
+        return 'DELETE FROM ONLY {table_name} {returning}'
+
+    @property
+    def db__delete_filtered(self):
+        return self.db__delete_all.replace('{returning}', 'WHERE ( {condition} ) {returning}')
+
     @property
     def db__create_field_index(self):
         return 'CREATE INDEX {index_name} ON {table_name} ({colum_name}) '
@@ -99,27 +207,101 @@ class GeneralManager(object):
         result = 'ORDER BY {}'.format(','.join(result))
         return result
 
+    @staticmethod
+    def grouping_syntax(group_by, having):
+        result = ''
+        if group_by:
+            result += 'GROUP BY {} '.format(', '.join(group_by))
+        if having:
+            result += 'HAVING {} '.format(having)
+        return result
+
+    @staticmethod
+    def placeholder_syntax(condition, offset):
+        '''shifts the $n placeholders of a chained condition after the ones already used'''
+        if not offset:
+            return condition
+        return PLACEHOLDER.sub(lambda m: '${}'.format(int(m.group(1)) + offset), condition)
+
+    @staticmethod
+    def limit_syntax(limit, offset):
+        result = ''
+        if limit is not None:
+            result += ' LIMIT {}'.format(int(limit))
+        if offset:
+            result += ' OFFSET {}'.format(int(offset))
+        return result
+
+    def query_shape(self, query_chain):
+        '''the structure of the chain (actions, columns, lookups, ordering...) without the values'''
+        return tuple(
+            tuple(sorted((k, freeze(v)) for k, v in q.items() if k not in self.value_keys))
+            for q in query_chain
+        )
+
+    @staticmethod
+    def query_values(query_chain):
+        values = list(query_chain[0].get('field_values') or [])
+        for q in query_chain[1:]:
+            values.extend(q.get('values', []))
+        return values
+
     def construct_query(self, query_chain):
+        # the same shape always compiles to the same sql, only the values change
+        shape = getattr(query_chain, 'shape', None) or self.query_shape(query_chain)
+        query_chain = list(query_chain)
+
+        query = self._compiled.get(shape)
+        if query is None:
+            query = self.compile_query(query_chain)
+            self._compiled.set(shape, query)
+
+        values = self.query_values(query_chain)
+
+        logger.debug('QUERY: {}, VALUES: {}'.format(query, values))
+        return query, values
+
+    def compile_query(self, query_chain):
         # here we take the query_chain and convert to a real sql sentence
-        res_dict = query_chain.pop(0)
+        res_dict = dict(query_chain[0])
+        n_values = len(res_dict.get('field_values') or [])
 
-        for q in query_chain:
+        for q in query_chain[1:]:
             if q['action'] == 'db__where':
-                if res_dict['action'] == 'db__select_all':
-                    res_dict.update({'action': 'db__select'})
+                if res_dict['action'] in self.filtered_actions:
+                    res_dict.update({'action': self.filtered_actions[res_dict['action']]})
+
+                q_condition = self.placeholder_syntax(q['condition'], n_values)
+                n_values += len(q.get('values', []))
 
                 condition = res_dict.get('condition', '')
                 if condition:
-                    condition = ' AND '.join([condition, q['condition']])
+                    condition = ' AND '.join([condition, q_condition])
                 else:
-                    condition = q['condition']
+                    condition = q_condition
 
                 res_dict.update({'condition': condition})
+            elif q['action'] == 'db__having':
+                q_condition = self.placeholder_syntax(q['condition'], n_values)
+                n_values += len(q.get('values', []))
+
+                having = res_dict.get('having', '')
+                res_dict['having'] = having and ' AND '.join([having, q_condition]) or q_condition
+            elif q['action'] == 'db__qualify':
+                q_condition = self.placeholder_syntax(q['condition'], n_values)
+                n_values += len(q.get('values', []))
+
+                qualify = res_dict.get('qualify', '')
+                res_dict['qualify'] = qualify and ' AND '.join([qualify, q_condition]) or q_condition
             elif q['action'] == 'db__select_related':
                 for model_join in q['fields']:
                     join_const = getattr(
                         self, q['action']).format(**model_join)
                     res_dict['join'] += join_const
+                    if res_dict.get('group_by'):
+                        # the joined columns depend on the primary key of their table
+                        res_dict['group_by'] = res_dict['group_by'] + [
+                            '{alias}.{model_db_pk}'.format(**model_join)]
 
                     select = res_dict['select'][:]
 
@@ -128,8 +310,8 @@ class GeneralManager(object):
                     elif select == '*':
                         select = select.replace(
                             '*',
-                            '{left_table}.*, {f_formatter}'.format(
-                                left_table=model_join['left_table'],
+                            '{table_name}.*, {f_formatter}'.format(
+                                table_name=res_dict['table_name'],
                                 f_formatter=model_join['fields_formatter'],
                             )
                         )
@@ -137,37 +319,185 @@ class GeneralManager(object):
                     else:
                         res_dict['select'] += ', ' + model_join['fields_formatter']
 
-        # if we are not counting, then we can assign ordering
+        table_name = res_dict.get('table_name')
+        if res_dict.get('qualify'):
+            # the window functions are calculated in a subquery named as the table, filtered outside
+            res_dict = self.qualified_query(res_dict)
+        if res_dict.get('with_total'):
+            # the rows of the whole query, before the slice
+            res_dict['select'] += ', COUNT(*) OVER () AS _total'
+
+        # if we are not counting, then we can assign ordering and slicing
         operations = ['COUNT', 'MAX', 'MIN', 'SUM', 'AVG', 'STDDEV']
+        limit = self.limit_syntax(res_dict.get('limit'), res_dict.get('offset'))
+        grouping = self.grouping_syntax(res_dict.get('group_by'), res_dict.get('having'))
         if res_dict.get('select', '').split('(')[0] not in operations:
-            res_dict['ordering'] = self.ordering_syntax(res_dict.get('ordering', []))
+            res_dict['ordering'] = grouping + self.ordering_syntax(res_dict.get('ordering', [])) + limit
+            query = getattr(self, res_dict['action']).format(**res_dict)
+        elif limit or grouping:
+            # the calculation has to be done over the slice (or the groups), not over the whole table
+            select = res_dict['select']
+            res_dict.update({
+                'select': ', '.join(res_dict.get('group_by') or ['*']),
+                'ordering': grouping + self.ordering_syntax(res_dict.get('ordering', [])) + limit,
+            })
+            query = self.db__select_sliced.format(
+                select=select,
+                subquery=getattr(self, res_dict['action']).format(**res_dict),
+                table_name=table_name,
+            )
         else:
             res_dict['ordering'] = ''
+            query = getattr(self, res_dict['action']).format(**res_dict)
 
-        query = getattr(self, res_dict['action']).format(**res_dict)
-        query = self.query_clean(query)
+        return self.query_clean(query)
+
+    def qualified_query(self, res_dict):
+        windowed, select = res_dict['window_select'], res_dict['select']
+        inner = dict(res_dict, ordering=self.grouping_syntax(res_dict.get('group_by'), res_dict.get('having')))
+        if select.startswith(windowed):
+            select = '*'
+        else:
+            # the select was replaced (COUNT, exists...), the windows are still needed to filter
+            inner['select'] = windowed
 
-        logger.debug('QUERY: {}, VALUES: {}'.format(query, res_dict.get('field_values')))
-        return query, res_dict.get('field_values')
+        return dict(
+            res_dict,
+            action='db__select',
+            select=select,
+            table_name='({}) AS {}'.format(getattr(self, inner['action']).format(**inner), res_dict['table_name']),
+            join='',
+            condition=res_dict['qualify'],
+            group_by=None,
+            having=None,
+        )
 
 
 class PostgresManager(GeneralManager):
+    # asyncpg's defaults, for the connections that do not tell theirs
+    statement_cache_size = 100
+    max_cacheable_statement_size = 1024 * 15
+    # bind parameters allowed by the protocol in a single statement
+    max_parameters = 32767
 
     def __init__(self, pool):
+        super().__init__()
         self.pool = pool
-        
+        self.warm_up_queries = []
+        self.statement_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._statements = weakref.WeakKeyDictionary()
+        self._warmed = weakref.WeakSet()
+
     async def get_conn(self):
         return await self.pool.acquire()
 
+    @property
+    def statement_cache_stats(self):
+        return cache_info(self.statement_stats)
+
+    @staticmethod
+    def normalize_query(query):
+        return ' '.join(query.split())
+
+    def statement_cache_config(self, raw_conn):
+        '''the size of the statement cache of the connection, and of the largest statement it keeps'''
+        config = getattr(raw_conn, '_config', None)
+        return (
+            getattr(config, 'statement_cache_size', self.statement_cache_size),
+            getattr(config, 'max_cacheable_statement_size', self.max_cacheable_statement_size),
+        )
+
+    async def warm_up(self, conn):
+        '''prepares the hot statements of every model in a connection new to the manager'''
+        raw_conn = getattr(conn, '_con', conn)
+        # parsed, planned and kept in the cache of the connection as fetch does, but not run
+        # asyncpg versions without it still get them checked by the public prepare
+        get_statement = getattr(raw_conn, '_get_statement', None)
+        for query, _ in self.warm_up_queries:
+            statement = await self.prepare(conn, query)
+            try:
+                if get_statement is not None:
+                    await get_statement(statement, None)
+                else:
+                    await conn.prepare(statement)
+            except asyncpg.PostgresError:
+                # the table may not exist yet, it will be prepared on first use
+                self._statements[raw_conn][0].discard(self.normalize_query(query))
+                logger.debug('unable to warm up: {}'.format(query))
+
+    async def prepare(self, conn, query):
+        '''
+        Returns the statement text to run in that connection, queries that only differ in
+        whitespace share the same text, so they hit the same prepared statement
+        '''
+        # asyncpg invalidates PreparedStatement objects once the connection goes back to the pool
+        # but keeps its own per connection cache, keyed by the statement text, this one mirrors it
+        raw_conn = getattr(conn, '_con', conn)
+        if raw_conn not in self._statements:
+            size, max_statement = self.statement_cache_config(raw_conn)
+            self._statements[raw_conn] = (LRUCache(size, self.statement_stats), max_statement)
+        cache, max_statement = self._statements[raw_conn]
+
+        if raw_conn not in self._warmed and not conn.is_in_transaction():
+            # a failing warm up would abort the transaction, so it waits for one out of it
+            self._warmed.add(raw_conn)
+            await self.warm_up(conn)
+
+        key = self.normalize_query(query)
+        statement = cache.get(key)
+        if statement is None:
+            statement = query
+            if cache.maxsize and (not max_statement or len(query) <= max_statement):
+                # the statements asyncpg does not keep are prepared every time
+                cache.set(key, statement)
+        return statement
+
+    @staticmethod
+    def is_preparable(method, values):
+        # asyncpg prepares (and caches) everything but execute without values, a simple query
+        return method != 'execute' or bool(values)
+
+    async def execute_query(self, conn, method, query, values):
+        '''runs the query through the prepared statements of the connection when possible'''
+        if self.is_preparable(method, values):
+            query = await self.prepare(conn, query)
+        return await getattr(conn, method)(query, *values)
+
+    async def estimate_rows(self, table_name):
+        '''the rows of the table according to the planner statistics, None if it was never analyzed'''
+        record = await self.request((
+            'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass($1)', [table_name.lower()]))
+        if record is None or record[0] < 0:
+            return None
+        return record[0]
+
+    async def explain(self, query):
+        '''the plan of the statement as estimated by the planner, it is not run'''
+        record = await self.request(('EXPLAIN (FORMAT JSON) {}'.format(query[0]), query[1]))
+        return json.loads(record[0])[0]['Plan']
+
+    async def copy_records(self, conn, table_name, columns, records):
+        '''sends the records using COPY, the fastest way to insert rows'''
+        # COPY quotes the names, the tables and columns are created unquoted so they are lowercase
+        return await conn.copy_records_to_table(
+            table_name.lower(), records=records, columns=[c.lower() for c in columns])
+
+    async def fetch(self, query):
+        '''all the rows of a single statement, no cursor and no explicit transaction'''
+        logger.debug('QUERY: {}'.format(query))
+        async with self.pool.acquire() as conn:
+            return await self.execute_query(conn, 'fetch', query[0], query[1] or [])
+
+    async def execute(self, query):
+        '''runs a statement that returns no rows, returns the status ("DELETE 3"...)'''
+        logger.debug('QUERY: {}'.format(query))
+        async with self.pool.acquire() as conn:
+            return await self.execute_query(conn, 'execute', query[0], query[1] or [])
+
     async def request(self, query):
         logger.debug('QUERY: {}'.format(query))
+        if not isinstance(query, (tuple, list)):
+            query = (query, [])
+
         async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                if isinstance(query, (tuple, list)):
-                    if query[1]:
-                        result = await conn.fetchrow(query[0], *query[1])
-                    else:
-                        result = await conn.fetchrow(query[0])
-                else:
-                    result = await conn.fetchrow(query)
-        return result
+            return await self.execute_query(conn, 'fetchrow', query[0], query[1] or [])
@@ -0,0 +1,95 @@
+__all__ = [
+    'Aggregate', 'Avg', 'Count', 'DenseRank', 'Max', 'Min', 'Rank', 'RowNumber', 'StdDev', 'Sum', 'Window',
+]
+
+
+class Aggregate(object):
+    '''
+    An aggregate function over a field of the model, to be used in aggregate() and annotate()
+    filter restricts the rows it is calculated over (FILTER (WHERE ...)), it takes the same
+    lookups as Queryset.filter, so several conditional aggregates come from the same scan
+    '''
+    function = None
+    # the function only makes sense over numeric fields
+    numeric = False
+
+    def __init__(self, field_name, filter=None, distinct=False):
+        self.field_name = field_name
+        self.filter = filter or {}
+        self.distinct = distinct
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.field_name)
+
+
+class Count(Aggregate):
+    '''the field can be "*", the rows themselves'''
+    function = 'COUNT'
+
+
+class Max(Aggregate):
+    function = 'MAX'
+
+
+class Min(Aggregate):
+    function = 'MIN'
+
+
+class Sum(Aggregate):
+    function = 'SUM'
+    numeric = True
+
+
+class Avg(Aggregate):
+    function = 'AVG'
+    numeric = True
+
+
+class StdDev(Aggregate):
+    function = 'STDDEV'
+    numeric = True
+
+
+class WindowFunction(object):
+    '''a function only calculated over a Window, the position of the row in its partition'''
+    function = None
+
+    def __repr__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+
+class RowNumber(WindowFunction):
+    function = 'ROW_NUMBER'
+
+
+class Rank(WindowFunction):
+    function = 'RANK'
+
+
+class DenseRank(WindowFunction):
+    function = 'DENSE_RANK'
+
+
+class Window(object):
+    '''
+    A window function or an aggregate calculated for each row over the rows of its partition,
+    to be used in annotate(), the rows are not grouped. Filtering by it keeps the rows whose value
+    matches, so filter(rank__lte=3) are the first three of each partition
+    annotate(rank=Window(RowNumber(), partition_by='author', order_by='-price'))
+    '''
+
+    def __init__(self, expression, partition_by=None, order_by=None):
+        self.expression = expression
+        self.partition_by = self._as_list(partition_by)
+        self.order_by = self._as_list(order_by)
+
+    @staticmethod
+    def _as_list(fields):
+        if fields is None:
+            return []
+        if isinstance(fields, str):
+            return [fields]
+        return list(fields)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.expression)
@@ -1,15 +1,24 @@
-from asyncpg.exceptions import UniqueViolationError, InsufficientPrivilegeError
-from asyncorm.log import logger
-from copy import deepcopy
+from asyncpg.exceptions import (
+    InsufficientPrivilegeError, InvalidColumnReferenceError, UniqueViolationError,
+)
+from collections import OrderedDict, deque, namedtuple
 
 from asyncorm.database import Cursor
+from asyncorm.database.cache import LRUCache
+from asyncorm.manager.aggregates import Aggregate, Count, Window, WindowFunction
 from asyncorm.exceptions import (
     ModelDoesNotExist, ModelError, MultipleObjectsReturned, QuerysetError,
 )
-from asyncorm.models.fields import CharField, ForeignKey, ManyToManyField, NumberField, AutoField
+from asyncorm.manager.query import Query
+from asyncorm.models.fields import (
+    ArrayField, AutoField, CharField, ForeignKey, ManyToManyField, NumberField,
+)
 
+import base64
 import datetime
 import json
+from decimal import Decimal
+from uuid import UUID
 
 __all__ = ['ModelManager', 'Queryset']
 
@@ -19,25 +28,79 @@ LOOKUP_OPERATOR = {
     'gte': '{t_n}.{k} >= {v}',
     'lte': '{t_n}.{k} <= {v}',
     'range': '({t_n}.{k}>={min} AND {t_n}.{k}<={max})',
-    'in': '{t_n}.{k} = ANY (array[{v}])',
-    'exact': '{t_n}.{k} LIKE \'{v}\'',
-    'iexact': '{t_n}.{k} ILIKE \'{v}\'',
-    'contains': '{t_n}.{k} LIKE \'%{v}%\'',
-    'icontains': '{t_n}.{k} ILIKE \'%{v}%\'',
-    'startswith': '{t_n}.{k} LIKE \'{v}%\'',
-    'istartswith': '{t_n}.{k} ILIKE \'{v}%\'',
-    'endswith': '{t_n}.{k} LIKE \'%{v}\'',
-    'iendswith': '{t_n}.{k} ILIKE \'%{v}\'',
+    'in': '{t_n}.{k} = ANY ({v})',
+    'exact': '{t_n}.{k} LIKE {v}',
+    'iexact': '{t_n}.{k} ILIKE {v}',
+    'contains': '{t_n}.{k} LIKE {v}',
+    'icontains': '{t_n}.{k} ILIKE {v}',
+    'startswith': '{t_n}.{k} LIKE {v}',
+    'istartswith': '{t_n}.{k} ILIKE {v}',
+    'endswith': '{t_n}.{k} LIKE {v}',
+    'iendswith': '{t_n}.{k} ILIKE {v}',
     'regex': '{t_n}.{k} ~ {v}',
     'iregex': '{t_n}.{k} ~* {v}',
     'date': '{t_n}.{k}::date = {v}::date',
     'isnull': '{t_n}.{k} {v}'
 }
 
+# how the value is bound for each of the string lookups
+STRING_LOOKUP_PATTERN = {
+    'exact': '{}',
+    'iexact': '{}',
+    'contains': '%{}%',
+    'icontains': '%{}%',
+    'startswith': '{}%',
+    'istartswith': '{}%',
+    'endswith': '%{}',
+    'iendswith': '%{}',
+}
+
+
+# (name, type, dump, load) the order matters, datetime is a subclass of date
+TOKEN_TYPES = (
+    ('datetime', datetime.datetime,
+     lambda v: v.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+     lambda v: datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f')),
+    ('date', datetime.date,
+     lambda v: v.strftime('%Y-%m-%d'),
+     lambda v: datetime.datetime.strptime(v, '%Y-%m-%d').date()),
+    ('time', datetime.time,
+     lambda v: v.strftime('%H:%M:%S.%f'),
+     lambda v: datetime.datetime.strptime(v, '%H:%M:%S.%f').time()),
+    ('decimal', Decimal, str, Decimal),
+    ('uuid', UUID, str, UUID),
+)
+
+
+def encode_token(values):
+    '''opaque (and url safe) representation of the last values of a page'''
+    encoded = []
+    for value in values:
+        for type_name, value_type, dump, _ in TOKEN_TYPES:
+            if isinstance(value, value_type):
+                encoded.append([type_name, dump(value)])
+                break
+        else:
+            encoded.append([None, value])
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    loaders = {type_name: load for type_name, _, _, load in TOKEN_TYPES}
+    try:
+        encoded = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return [loaders[t](v) if t else v for t, v in encoded]
+    except (ValueError, TypeError, KeyError):
+        raise QuerysetError('Not a correct pagination token')
+
 
 class Queryset(object):
     db_manager = None
     orm = None
+    # bounded slices up to this size are fetched at once instead of using a cursor
+    fetch_limit = 100
+    # record decoders, shared by all the querysets
+    decoders = LRUCache(512)
 
     def __init__(self, model):
         self.model = model
@@ -46,26 +109,39 @@ class Queryset(object):
         self.select = '*'
 
         self.query = None
+        self._basic_query = None
 
         self._cursor = None
-        self._results = []
-
-        self.forward = 0
-        self.stop = None
-        self.step = None
+        self._cursor_options = {}
+        self._results = None
+        # converts the records into what the iteration returns, the model instances by default
+        self._row_parser = None
+        # 'slots' or 'lazy' for the compact instances, by default what the model Meta says
+        self._compact = None
+        self._decoder = None
+        self._sql = None
+        # the relations loaded with prefetch_related
+        self._prefetch = ()
+        # what values() / values_list() return: (kind, fields, recompose, option)
+        self._values = None
+        # the aggregates calculated for each group, by name
+        self._annotations = OrderedDict()
 
     def query_copy(self):
-        return self.query and deepcopy(self.query) or deepcopy(self.basic_query)
+        # queries are immutable, so they can be shared instead of copied
+        return self.query or self.basic_query
 
     @property
     def basic_query(self):
-        return [{
-            'action': 'db__select_all',
-            'select': '*',
-            'table_name': self.model.cls_tablename(),
-            'ordering': self.model.ordering,
-            'join': '',
-        }]
+        if self._basic_query is None:
+            self._basic_query = Query({
+                'action': 'db__select_all',
+                'select': '*',
+                'table_name': self.model.cls_tablename(),
+                'ordering': self.model.ordering,
+                'join': '',
+            })
+        return self._basic_query
 
     @classmethod
     def set_orm(cls, orm):
@@ -166,41 +242,98 @@ class Queryset(object):
         unique_string = ' UNIQUE ({}) '.format(','.join(self.model.unique_together))
         return self.model.unique_together and unique_string or ''
 
+    def warm_up_queries(self):
+        '''statements worth having prepared in every connection, the get by primary key'''
+        queryset = self._get_queryset({self.model.orm_pk: 0})
+        return [self.db_manager.construct_query(queryset.query)]
+
+    @property
+    def compact_mode(self):
+        return self._compact or (self.model.compact and 'slots' or None)
+
+    def build_result(self, record):
+        if self._row_parser is not None:
+            return self._row_parser(record)
+        if self._decoder is None:
+            # all the records of the iteration share the same columns
+            self._decoder = self.row_decoder(record, self._sql)
+            self._instance_class = self.compact_mode and self.model.compact_class() or self.model
+        return self._decoder(record, self._instance_class._from_db())
+
+    def row_decoder(self, record, sql=None):
+        '''the decoder of the records of a query, built once for each model and statement'''
+        lazy = self.compact_mode == 'lazy'
+        # the join aliases are positional, without the statement the joined paths tell them apart
+        key = (self.model, sql or (tuple(record.keys()), self._joined_paths()), lazy)
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            decoder = self.model.row_decoder(list(record.keys()), self.query or (), lazy=lazy)
+            self.decoders.set(key, decoder)
+        return decoder
+
+    def _joined_paths(self):
+        return tuple(
+            join['path'] for q in self.query or () if q['action'] == 'db__select_related' for join in q['fields'])
+
     def modelconstructor(self, record, instance=None):
         if not instance:
-            instance = self.model()
-
-        data = {}
-        for k, v in record.items():
-            select_related = []
-            splitted = k.split('__')
-            if len(splitted) > 1:
-                if splitted[0] not in select_related:
-                    select_related.append(splitted[0])
-            else:
-                data.update({k: v})
-
-        if select_related:
-            pass
+            instance = (self.compact_mode and self.model.compact_class() or self.model)._from_db()
+        return self.row_decoder(record)(record, instance)
 
-        instance.construct(data, subitems=self.query)
-        return instance
+    async def count(self, estimate=False, threshold=None):
+        '''
+        The number of rows, with estimate it comes from the planner statistics instead
+        of counting them: those of the table when nothing filters it, the EXPLAIN row
+        estimate otherwise. Estimates under threshold are counted exactly anyway
+        '''
+        if estimate:
+            estimated = await self._estimate_count()
+            if estimated is not None and (threshold is None or estimated >= threshold):
+                return estimated
 
-    async def count(self):
         query = self.query_copy()
-        query[0]['select'] = 'COUNT(*)'
+        if query[0].get('limit') is not None or query[0].get('offset'):
+            if self._annotations:
+                # the slice may be ordered by the annotations, they have to stay selected under it
+                sql, values = self.db_manager.construct_query(query)
+                t_n = self.model.table_name or self.model.__name__.lower()
+                sql = self.db_manager.db__select_sliced.format(
+                    select='COUNT(*)', subquery=sql.rstrip(';'), table_name=t_n)
+                sql = self.db_manager.query_clean(sql)
+                resp = await self.db_manager.request((sql, values))
+                return resp[0]
+        else:
+            # the order may be by the annotations, and it does not change the count
+            query = query.replace(ordering=[])
+
+        # the annotations are not part of the count, only their groups
+        query = query.replace(select='COUNT(*)', field_values=self._window_values(query))
 
         resp = await self.db_request(query)
         for v in resp.values():
             return v
 
-    async def exists(self):
+    async def _estimate_count(self):
         query = self.query_copy()
-        query[0]['action'] = 'db__exists'
+        base = query[0]
+        filtered = [q for q in query if q['action'] in ('db__where', 'db__having', 'db__qualify')]
+        if not filtered and not base.get('group_by') and base.get('limit') is None and not base.get('offset'):
+            return await self.db_manager.estimate_rows(self.model.cls_tablename())
 
-        resp = await self.db_request(query)
-        for v in resp.values():
-            return v
+        plan = await self.db_manager.explain(self.db_manager.construct_query(query))
+        return int(plan['Plan Rows'])
+
+    async def exists(self):
+        '''SELECT 1 ... LIMIT 1, the rows themselves are never read'''
+        queryset = self._slice(0, 1)
+        query = queryset.query
+        if not query[0].get('offset'):
+            # without an offset the order does not change what is found
+            query = query.replace(ordering=[])
+
+        query = query.replace(select='1', field_values=self._window_values(query))
+        resp = await self.db_manager.request(self.db_manager.construct_query(query))
+        return resp is not None
 
     async def calculate(self, field_name, operation):
         if hasattr(self.model, field_name):
@@ -211,12 +344,105 @@ class Queryset(object):
             raise QuerysetError('{} is not a numeric field'.format(field_name))
 
         query = self.query_copy()
-        query[0]['select'] = '{}({})'.format(operation, field_name)
+        query = query.replace(
+            select='{}({})'.format(operation, field_name), field_values=self._window_values(query))
 
         resp = await self.db_request(query)
         for v in resp.values():
             return v
 
+    @staticmethod
+    def _window_values(query):
+        # the values of the select, still needed once it is replaced if the windows are filtered
+        if any(q['action'] == 'db__qualify' for q in query):
+            return list(query[0].get('field_values') or [])
+        return []
+
+    @staticmethod
+    def _check_alias(alias):
+        # the same rules as the db columns, the row decoders skip the other ones
+        if not alias.isidentifier() or alias.startswith('_') or alias.endswith('_') or '__' in alias:
+            raise QuerysetError('{} is not a correct name for an aggregate'.format(alias))
+
+    def _aggregate_expression(self, aggregate, offset):
+        # the sql of the aggregate, the placeholders of its filter come after offset
+        if not isinstance(aggregate, Aggregate):
+            raise QuerysetError('{!r} is not an aggregate'.format(aggregate))
+
+        if aggregate.field_name == '*':
+            if not isinstance(aggregate, Count):
+                raise QuerysetError('Only Count can be calculated over "*"')
+            column = '*'
+        else:
+            field = self.model.fields.get(aggregate.field_name)
+            if field is None or isinstance(field, ManyToManyField):
+                raise QuerysetError(
+                    '{} is not a correct field for {}'.format(aggregate.field_name, self.model.__name__))
+            if aggregate.numeric and not isinstance(field, NumberField):
+                raise QuerysetError('{} is not a numeric field'.format(aggregate.field_name))
+            column = '{}.{}'.format(self.model.table_name or self.model.__name__.lower(), field.db_column)
+
+        expression = '{}({}{})'.format(aggregate.function, aggregate.distinct and 'DISTINCT ' or '', column)
+        if not aggregate.filter:
+            return expression, []
+
+        filters, values = self.calc_filters(aggregate.filter, False)
+        condition = self.db_manager.placeholder_syntax(' AND '.join(filters), offset)
+        return '{} FILTER (WHERE {})'.format(expression, condition), values
+
+    def _annotation_expression(self, annotation, offset):
+        # the sql of an annotation, an aggregate over the groups or a Window over the partitions
+        if not isinstance(annotation, Window):
+            return self._aggregate_expression(annotation, offset)
+
+        if isinstance(annotation.expression, WindowFunction):
+            expression, values = '{}()'.format(annotation.expression.function), []
+        else:
+            expression, values = self._aggregate_expression(annotation.expression, offset)
+
+        window = []
+        if annotation.partition_by:
+            window.append('PARTITION BY {}'.format(
+                ', '.join([self._window_column(f) for f in annotation.partition_by])))
+        if annotation.order_by:
+            window.append(self.db_manager.ordering_syntax([
+                f[0] == '-' and '-' + self._window_column(f[1:]) or self._window_column(f)
+                for f in annotation.order_by
+            ]))
+        return '{} OVER ({})'.format(expression, ' '.join(window)), values
+
+    def _window_column(self, field_name):
+        field = self.model.fields.get(field_name)
+        if field is None or isinstance(field, ManyToManyField):
+            raise QuerysetError('{} is not a correct field for {}'.format(field_name, self.model.__name__))
+        return '{}.{}'.format(self.model.table_name or self.model.__name__.lower(), field.db_column)
+
+    def _aggregates_select(self, aggregates, offset=0):
+        expressions, values = [], []
+        for alias in sorted(aggregates):
+            self._check_alias(alias)
+            expression, aggregate_values = self._aggregate_expression(aggregates[alias], offset + len(values))
+            expressions.append('{} AS "{}"'.format(expression, alias))
+            values.extend(aggregate_values)
+        return ', '.join(expressions), values
+
+    async def aggregate(self, **aggregates):
+        '''
+        Calculates all the aggregates in a single SELECT, returns a dict with them by name
+        aggregate(total=Sum('price'), n=Count('*'), cheap=Count('*', filter={'price__lt': 10}))
+        '''
+        if not aggregates:
+            raise QuerysetError('aggregate requires the aggregates to calculate')
+
+        # the joined foreign keys do not change the rows aggregated
+        query = Query.from_nodes([q for q in self.query_copy() if q['action'] != 'db__select_related'])
+        window_values = self._window_values(query)
+        select, values = self._aggregates_select(aggregates, len(window_values))
+        query = query.replace(select=select, field_values=window_values + values)
+
+        record = await self.db_manager.request(self.db_manager.construct_query(query))
+        return dict(record.items())
+
     async def Max(self, field_name):
         return await self.calculate(field_name, 'MAX')
 
@@ -232,28 +458,83 @@ class Queryset(object):
     async def StdDev(self, field_name):
         return await self.calculate(field_name, 'STDDEV')
 
-    async def get(self, **kwargs):
-        count = 0
-        queryset = self.queryset().filter(**kwargs)
+    def _get_queryset(self, kwargs):
+        # two rows are enough to know if there is more than one
+        queryset = kwargs and self.filter(**kwargs) or self.queryset()
+        return queryset._slice(0, 2)
 
-        async for itm in queryset:
-            count += 1
+    async def get(self, **kwargs):
+        '''a single fetch of up to two rows, no cursor and no transaction'''
+        queryset = self._get_queryset(kwargs)
+        query = self.db_manager.construct_query(queryset.query)
+        results = await self.db_manager.fetch(query)
 
-        if count > 1:
+        if len(results) > 1:
+            count = await (kwargs and self.filter(**kwargs) or self).count()
             raise MultipleObjectsReturned(
                 'More than one "{}" were returned, there are {}!'.format(self.model.__name__, count))
-        elif count == 0:
+        elif not results:
             raise self.model.DoesNotExist('That {} does not exist'.format(self.model.__name__))
 
-        return itm
+        queryset._sql = query[0]
+        result = queryset.build_result(results[0])
+        await queryset._prefetch_related([result])
+        return result
 
     async def first(self):
-        try:
-            obj = await self[0]
-        except IndexError:
-            obj = None
-        return obj
-        
+        '''the first one in the queryset ordering, by primary key (or the groups) when unordered, or None'''
+        queryset = self._slice(0, 1)
+        base = queryset.query[0]
+        if not base.get('ordering'):
+            t_n = self.model.table_name or self.model.__name__.lower()
+            ordering = base.get('group_by') or ['{}.{}'.format(t_n, self.model.db_pk)]
+            queryset.query = queryset.query.replace(ordering=ordering)
+
+        query = self.db_manager.construct_query(queryset.query)
+        record = await self.db_manager.request(query)
+        if record is None:
+            return None
+
+        queryset._sql = query[0]
+        result = queryset.build_result(record)
+        await queryset._prefetch_related([result])
+        return result
+
+    async def page(self, number, size, with_total=True):
+        '''
+        Returns (results, total), the results of the page number (from 1) of size rows and
+        the rows of the whole queryset, counted in the same statement with COUNT(*) OVER ()
+        total is None without with_total
+        '''
+        if not isinstance(number, int) or number < 1:
+            raise QuerysetError('The page number has to be a positive integer')
+        if not isinstance(size, int) or size < 1:
+            raise QuerysetError('The page size has to be a positive integer')
+
+        queryset = self._slice((number - 1) * size, number * size)
+        base = queryset.query[0]
+        if not base.get('ordering'):
+            # the pages have to be stable, by primary key (or the groups) when unordered
+            t_n = self.model.table_name or self.model.__name__.lower()
+            ordering = base.get('group_by') or ['{}.{}'.format(t_n, self.model.db_pk)]
+            queryset.query = queryset.query.replace(ordering=ordering)
+        if with_total:
+            queryset.query = queryset.query.replace(with_total=True)
+
+        query = self.db_manager.construct_query(queryset.query)
+        records = await self.db_manager.fetch(query)
+        queryset._sql = query[0]
+        results = await queryset._prefetch_related([queryset.build_result(r) for r in records])
+
+        total = None
+        if with_total:
+            if records:
+                total = records[0]['_total']
+            else:
+                # past the last page there is no row to count them
+                total = number > 1 and await self.count() or 0
+        return results, total
+
     #CHAINABLE QUERYSET METHODS
     def queryset(self):
         return self._copy_me()
@@ -264,53 +545,346 @@ class Queryset(object):
     def none(self):
         queryset = self._copy_me()
 
-        kwargs = {self.model.db_pk: -1}
+        kwargs = {self.model.orm_pk: -1}
         return queryset.filter(**kwargs)
 
     def select_related(self, *args):
+        '''
+        The foreign keys come as the related instances, joined in the same query,
+        following them with "__" to any depth (book's author__publisher)
+        Each join gets a positional alias (j1, j2...) and so do its columns (j1__0, j1__1...)
+        '''
+        query = self.query_copy()
+        # the paths already joined in the chain, and their aliases
+        joined = {}
+        for node in query:
+            if node['action'] == 'db__select_related':
+                for join in node['fields']:
+                    joined[join['path']] = join['alias']
+
         select_related = {'action': 'db__select_related', 'fields': []}
         for arg in args:
-            # fr the time been we overlook the after the '__'
-            if '__' in arg:
-                arg = arg.split('__')[0]
-            if not hasattr(self.model, arg):
-                raise QuerysetError('{} is not a {} attribute.'.format(arg, self.model.__name__))
-            fk_field = getattr(self.model, arg)
-            if not isinstance(fk_field, ForeignKey):
-                raise QuerysetError(
-                    '{} is not a ForeignKey Field for {}.'.format(arg, self.model.__name__))
-            model = self.orm.get_model(getattr(self.model, arg).foreign_key)
+            model, left_table, path = self.model, self.model.cls_tablename(), []
+            for name in arg.split('__'):
+                if not hasattr(model, name):
+                    raise QuerysetError('{} is not a {} attribute.'.format(name, model.__name__))
+                fk_field = getattr(model, name)
+                if not isinstance(fk_field, ForeignKey):
+                    raise QuerysetError(
+                        '{} is not a ForeignKey Field for {}.'.format(name, model.__name__))
+                model = self.orm.get_model(fk_field.foreign_key)
+                path.append(name)
+
+                join_path = '__'.join(path)
+                if join_path not in joined:
+                    alias = 'j{}'.format(len(joined) + 1)
+                    joined[join_path] = alias
+                    columns = model.get_db_columns()
+                    select_related['fields'].append({
+                        'path': join_path,
+                        'alias': alias,
+                        'right_table': model.cls_tablename(),
+                        'left_table': left_table,
+                        'foreign_field': fk_field.db_column or name,
+                        'model_db_pk': model.db_pk,
+                        'columns': columns,
+                        'fields_formatter': ', '.join([
+                            '{0}.{1} AS {0}__{2}'.format(alias, column, i) for i, column in enumerate(columns)
+                        ]),
+                    })
+                left_table = joined[join_path]
 
-            right_table = model.table_name or model.__name__.lower()
-            left_table = self.model.table_name or self.model.__name__.lower()
+        queryset = self._copy_me()
+        queryset.query = query.add(select_related)
 
-            fields_formatter = ', '.join([
-                '{right_table}.{field} AS {right_table}€$$€{field}'.format(
-                    right_table=right_table,
-                    field=field
-                ) for field in model.get_db_columns()
+        return queryset
+
+    def prefetch_related(self, *lookups):
+        '''
+        The related objects of the results are loaded after them, in a single query
+        for each relation whatever the number of results: the reverse foreign keys
+        (book_set), the many to many (by field or publisher_set) and the foreign keys,
+        nested with "__" (book_set__author)
+        '''
+        for lookup in lookups:
+            model = self.model
+            for name in lookup.split('__'):
+                _, relation = self._relation(model, name)
+                model = self.orm.get_model(relation['model'])
 
-            ])
-            fk_column = fk_field.db_column and fk_field.db_column or arg
-            select_related['fields'].append(
-                {
-                    'right_table': right_table,
-                    'left_table': left_table,
-                    'foreign_field': fk_column,
-                    'model_db_pk': model.db_pk,
-                    'fields_formatter': fields_formatter,
-                    'orm_fieldname': arg,
-                }
-            )
         queryset = self._copy_me()
-        queryset.query.append(select_related)
+        queryset._prefetch = self._prefetch + lookups
+        return queryset
+
+    @staticmethod
+    def _relation(model, name):
+        # the accessor where the related objects end, and how they are related
+        attr = getattr(model, name, None)
+        if isinstance(attr, ManyToManyField):
+            name = '{}_set'.format(attr.foreign_key.lower())
+            attr = getattr(model, name, None)
+        elif isinstance(attr, ForeignKey):
+            return name, {'kind': 'foreign_key', 'model': attr.foreign_key}
+
+        relation = getattr(attr, 'relation', None)
+        if relation is None:
+            raise QuerysetError('{} is not a relation of {}'.format(name, model.__name__))
+        return name, relation
+
+    async def _fetch_all(self):
+        # all the records at once, and the results with their related objects
+        records = await self.db_manager.fetch(self.db_manager.construct_query(self.query_copy()))
+        results = [self.build_result(r) for r in records]
+        return records, await self._prefetch_related(results)
+
+    async def _prefetch_related(self, results):
+        if not self._prefetch or not results:
+            return results
+        if self._row_parser is not None:
+            raise QuerysetError('prefetch_related requires model instances')
+
+        nested = OrderedDict()
+        for lookup in self._prefetch:
+            name, _, rest = lookup.partition('__')
+            nested.setdefault(name, [])
+            if rest:
+                nested[name].append(rest)
+
+        for name, lookups in nested.items():
+            accessor, relation = self._relation(self.model, name)
+            model = self.orm.get_model(relation['model'])
+            await getattr(self, '_prefetch_{}'.format(relation['kind']))(
+                results, accessor, relation, model, lookups)
+        return results
 
+    @staticmethod
+    def _distinct(values):
+        seen, result = set(), []
+        for value in values:
+            if value is not None and value not in seen:
+                seen.add(value)
+                result.append(value)
+        return result
+
+    @staticmethod
+    def _set_prefetched(instance, accessor, related):
+        prefetched = getattr(instance, '_prefetched', None)
+        if prefetched is None:
+            prefetched = instance._prefetched = {}
+        prefetched[accessor] = related
+
+    async def _prefetch_foreign_key(self, results, accessor, relation, model, lookups):
+        # the foreign key becomes the related instance, as with select_related
+        ids = self._distinct(getattr(r, accessor) for r in results)
+        if not ids:
+            return
+        queryset = model.objects.filter(**{'{}__in'.format(model.orm_pk): ids})
+        _, related = await queryset.prefetch_related(*lookups)._fetch_all()
+
+        by_pk = {getattr(r, model.orm_pk): r for r in related}
+        for result in results:
+            setattr(result, accessor, by_pk.get(getattr(result, accessor)))
+
+    async def _prefetch_reverse(self, results, accessor, relation, model, lookups):
+        ids = self._distinct(getattr(r, r.orm_pk) for r in results)
+        queryset = model.objects.filter(**{'{}__in'.format(relation['field']): ids})
+        records, related = await queryset.prefetch_related(*lookups)._fetch_all()
+
+        # by the column, the attribute may already be the instance if it was prefetched
+        column = model.fields[relation['field']].db_column
+        self._group_prefetched(results, accessor, [r[column] for r in records], related)
+
+    async def _prefetch_many_to_many(self, results, accessor, relation, model, lookups):
+        ids = self._distinct(getattr(r, r.orm_pk) for r in results)
+        t_n = model.table_name or model.__name__.lower()
+        m2m_column = '{}.{}'.format(relation['table_name'], relation['my_column'])
+
+        # the through table is joined, the columns of the ordering have to be qualified
+        ordering = []
+        for item in model.ordering or []:
+            descending = item.startswith('-') and '-' or ''
+            field = model.fields.get(item.lstrip('-'))
+            ordering.append(field and '{}{}.{}'.format(descending, t_n, field.db_column) or item)
+
+        queryset = model.objects.prefetch_related(*lookups)
+        queryset.query = queryset.query_copy().replace(
+            select='{} AS _related_to, {}.*'.format(m2m_column, t_n),
+            join='JOIN {m2m} ON {m2m}.{other} = {t_n}.{pk} '.format(
+                m2m=relation['table_name'], other=relation['other_column'], t_n=t_n, pk=model.db_pk),
+            ordering=ordering,
+        ).add({'action': 'db__where', 'condition': '{} = ANY ($1)'.format(m2m_column), 'values': [ids]})
+        records, related = await queryset._fetch_all()
+
+        self._group_prefetched(results, accessor, [r['_related_to'] for r in records], related)
+
+    def _group_prefetched(self, results, accessor, keys, related):
+        groups = {}
+        for key, instance in zip(keys, related):
+            groups.setdefault(key, []).append(instance)
+        for result in results:
+            self._set_prefetched(result, accessor, groups.get(getattr(result, result.orm_pk), []))
+
+    def iterator(self, chunk_size=20, prefetch=True, max_chunk_size=None):
+        '''
+        Iterates the queryset starting with pages of chunk_size rows that grow up to
+        max_chunk_size, with prefetch the next page is fetched in the background
+        '''
+        if chunk_size <= 0:
+            raise QuerysetError('chunk_size should be a positive integer')
+
+        queryset = self._copy_me()
+        queryset._cursor_options = {
+            'step': chunk_size,
+            'max_step': max_chunk_size or max(chunk_size, 2000),
+            'prefetch': prefetch,
+        }
         return queryset
 
+    def keyset_ordering(self):
+        '''the db columns the queryset is ordered by, ending with the primary key'''
+        columns, descending = [], set()
+        for item in (self.query or self.basic_query)[0].get('ordering') or []:
+            if item == 'random()':
+                raise QuerysetError('Random ordering can not be paginated')
+            field = self.model.fields.get(item.lstrip('-'))
+            if field is None or isinstance(field, ManyToManyField):
+                raise QuerysetError('The ordering by {} can not be paginated'.format(item.lstrip('-')))
+            descending.add(item[0] == '-')
+            columns.append(field.db_column)
+
+        if self.model.db_pk not in columns:
+            columns.append(self.model.db_pk)
+        if len(descending) > 1:
+            raise QuerysetError('Keyset pagination requires all the ordering in the same direction')
+        return columns, descending.pop() if descending else False
+
+    async def paginate(self, after=None, size=20):
+        '''
+        Keyset pagination, returns the page of size elements that comes after the
+        continuation token (from the start when None) and the token for the next page
+        '''
+        if size <= 0:
+            raise QuerysetError('size should be a positive integer')
+        if self._annotations or self.query_copy()[0].get('group_by'):
+            raise QuerysetError('Grouped or annotated querysets can not be paginated')
+
+        columns, descending = self.keyset_ordering()
+        t_n = self.model.table_name or self.model.__name__.lower()
+
+        query = self.query_copy()
+        if query[0].get('limit') is not None or query[0].get('offset'):
+            raise QuerysetError('Sliced querysets can not be paginated')
+
+        keys = columns
+        if query[0]['select'] != '*':
+            # only some columns are selected, the ones of the token come apart
+            keys = ['_keyset_{}'.format(i) for i in range(len(columns))]
+            query = query.replace(select=', '.join([query[0]['select']] + [
+                '{}.{} AS {}'.format(t_n, c, k) for c, k in zip(columns, keys)]))
+
+        if after is not None:
+            values = decode_token(after)
+            if len(values) != len(columns):
+                raise QuerysetError('Not a correct pagination token')
+            query = query.add({
+                'action': 'db__where',
+                'condition': '({}) {} ({})'.format(
+                    ', '.join(['{}.{}'.format(t_n, c) for c in columns]),
+                    descending and '<' or '>',
+                    ', '.join(['${}'.format(i + 1) for i in range(len(values))]),
+                ),
+                'values': values,
+            })
+
+        query = query.replace(
+            ordering=['{}{}.{}'.format(descending and '-' or '', t_n, c) for c in columns],
+            limit=size,
+        )
+        db_query = self.db_manager.construct_query(query)
+        records = await self.db_manager.fetch(db_query)
+
+        token = None
+        if len(records) == size:
+            token = encode_token([records[-1][k] for k in keys])
+        return await self._prefetch_related(self._built_results(records, db_query[0])), token
+
+    def _built_results(self, records, sql):
+        # the results of a statement run apart from the iteration, as the iteration builds them
+        queryset = self._copy_me()
+        queryset._sql = sql
+        return [queryset.build_result(r) for r in records]
+
+    def _modifying_query(self, action, returning):
+        query = self.query_copy()
+        if query[0].get('limit') is not None or query[0].get('offset'):
+            raise QuerysetError('Sliced querysets can not be updated or deleted')
+        if self._annotations or query[0].get('group_by') or any(
+                q['action'] in ('db__having', 'db__qualify') for q in query):
+            # the statement would only keep the where, and modify all the rows it matches
+            raise QuerysetError('Grouped or annotated querysets can not be updated or deleted')
+        # the columns selected, so values() returns them
+        return query.replace(action=action, returning=returning and 'RETURNING {}'.format(query[0]['select']) or '')
+
+    async def _modify(self, query, returning):
+        db_query = self.db_manager.construct_query(query)
+        try:
+            if returning:
+                # data modifying statements can not be run in a cursor, so they come at once
+                records = await self.db_manager.fetch(db_query)
+                return self._built_results(records, db_query[0])
+            status = await self.db_manager.execute(db_query)
+        except UniqueViolationError:
+            raise ModelError('The model violates a unique constraint')
+        return int(status.split()[-1])
+
+    async def update(self, returning=False, **kwargs):
+        '''
+        Updates all the rows of the queryset in a single UPDATE statement
+        returns the number of rows updated, or the updated instances with returning
+        '''
+        if not kwargs:
+            raise QuerysetError('update requires the fields to update')
+
+        field_schema, field_values = [], []
+        for field_name, value in kwargs.items():
+            field = self.model.fields.get(field_name)
+            if field is None:
+                raise QuerysetError('{} is not a correct field for {}'.format(field_name, self.model.__name__))
+            if isinstance(field, (AutoField, ManyToManyField)):
+                raise QuerysetError('{} field can not be updated'.format(field_name))
+
+            field_values.append(value if value is None else field.sanitize_data(value))
+            field_schema.append('{} = ${}'.format(field.db_column, len(field_values)))
+
+        query = self._modifying_query('db__update_all', returning).replace(
+            field_schema=', '.join(field_schema),
+            field_values=field_values,
+        )
+        return await self._modify(query, returning)
+
+    async def delete(self, returning=False):
+        '''
+        Deletes all the rows of the queryset in a single DELETE statement
+        returns the number of rows deleted, or the deleted instances with returning
+        '''
+        return await self._modify(self._modifying_query('db__delete_all', returning), returning)
+
+    @property
+    def fetch_stats(self):
+        '''pages, rows and (estimated) bytes fetched by the current iteration'''
+        if self._cursor:
+            return dict(self._cursor.stats)
+        return {'pages': 0, 'rows': 0, 'bytes': 0}
+
     def calc_filters(self, kwargs, exclude):
-        # recompose the filters
+        # recompose the filters, the values are not part of the sql
+        # they are returned apart to be sent as $n parameters
         bool_string = exclude and 'NOT ' or ''
-        filters = []
+        filters, values = [], []
+
+        def placeholder(value):
+            values.append(value)
+            return '${}'.format(len(values))
 
         for k, v in kwargs.items():
             # we format the key, the conditional and the value
@@ -322,18 +896,11 @@ class Queryset(object):
 
             field = getattr(self.model, k)
 
-            string_lookups = [
-                'exact', 'iexact',
-                'contains', 'icontains',
-                'startswith', 'istartswith',
-                'endswith', 'iendswith',
-            ]
             operator_formater = {
                 't_n': self.model.table_name or self.model.__name__.lower(),
                 'k': field.db_column,
-                'v': v
             }
-            if operator == '({t_n}.{k}>={min} AND {t_n}.{k}<={max})':
+            if lookup == 'range':
                 if not isinstance(v, (tuple, list)):
                     raise QuerysetError(
                         '{} should be list or a tuple'.format(lookup)
@@ -341,16 +908,17 @@ class Queryset(object):
                 if len(v) != 2:
                     raise QuerysetError('Not a correct tuple/list definition, should be of size 2')
                 operator_formater.update({
-                    'min': field.sanitize_data(v[0]),
-                    'max': field.sanitize_data(v[1]),
+                    'min': placeholder(field.sanitize_data(v[0])),
+                    'max': placeholder(field.sanitize_data(v[1])),
                 })
-            elif lookup in string_lookups:
+            elif lookup in STRING_LOOKUP_PATTERN:
                 is_charfield = isinstance(field, CharField)
                 # is_othercharfield = issubclass(field, CharField)
                 # if not is_charfield or not is_othercharfield:
                 if not is_charfield:
                     raise QuerysetError('{} not allowed in non CharField fields'.format(lookup))
-                operator_formater['v'] = field.sanitize_data(v)
+                operator_formater['v'] = placeholder(
+                    STRING_LOOKUP_PATTERN[lookup].format(field.sanitize_data(v)))
             elif lookup == "isnull":
                 if v is True:
                     operator_formater['v'] = "IS NULL"
@@ -358,39 +926,97 @@ class Queryset(object):
                     operator_formater['v'] = "IS NOT NULL"
                 else:
                     raise QuerysetError('{} not allowed lookup in bool value'.format(lookup))
+            elif v is None:
+                operator = operator.replace('=', 'IS')
+                operator_formater['v'] = 'NULL'
             else:
                 if isinstance(v, (list, tuple)):
-                    # check they are correct items and serialize
-                    v = ','.join(
-                        ["'{}'".format(field.sanitize_data(si))
-                         if isinstance(si, str) else str(si) for si in v])
+                    # check they are correct items
+                    v = [field.sanitize_data(si) for si in v]
                 elif isinstance(v, dict):
-                    v = "'{}'".format(json.dumps(v))
-                elif v is None:
-                    v = field.sanitize_data(v)[1:-1]
-                    operator = operator.replace('=', 'IS')
-                elif isinstance(v, (datetime.datetime, datetime.date)) or isinstance(field, (CharField)):
-                    v = "'{}'".format(v)
+                    v = json.dumps(v)
+                elif isinstance(v, (datetime.datetime, datetime.date)):
+                    pass
+                elif isinstance(field, CharField):
+                    v = str(v)
                 else:
                     v = field.sanitize_data(v)
-                operator_formater['v'] = v
+                operator_formater['v'] = placeholder(v)
 
             filters.append(
                 bool_string +
                 operator.format(**operator_formater)
             )
 
-        return filters
+        return filters, values
 
     def filter(self, exclude=False, **kwargs):
-        filters = self.calc_filters(kwargs, exclude)
-        condition = ' AND '.join(filters)
+        # the lookups over the annotations are applied to the groups (HAVING)
+        # or, over the windows, to the rows once they are calculated
+        having, qualify = {}, {}
+        for k in list(kwargs):
+            alias = k.split('__')[0]
+            if alias in self._annotations:
+                if isinstance(self._annotations[alias], Window):
+                    qualify[k] = kwargs.pop(k)
+                else:
+                    having[k] = kwargs.pop(k)
 
         queryset = self.queryset()
-
-        queryset.query.append({'action': 'db__where', 'condition': condition})
+        if kwargs or not (having or qualify):
+            filters, values = self.calc_filters(kwargs, exclude)
+            queryset.query = queryset.query.add(
+                {'action': 'db__where', 'condition': ' AND '.join(filters), 'values': values}
+            )
+        if having:
+            filters, values = self.having_filters(having, exclude)
+            queryset.query = queryset.query.add(
+                {'action': 'db__having', 'condition': ' AND '.join(filters), 'values': values}
+            )
+        if qualify:
+            filters, values = self.having_filters(qualify, exclude)
+            queryset.query = queryset.query.add(
+                {'action': 'db__qualify', 'condition': ' AND '.join(filters), 'values': values}
+            )
         return queryset
 
+    def having_filters(self, kwargs, exclude):
+        # as calc_filters, over the aggregates of the annotations
+        bool_string = exclude and 'NOT ' or ''
+        filters, values = [], []
+
+        def placeholder(value):
+            values.append(value)
+            return '${}'.format(len(values))
+
+        for k in sorted(kwargs):
+            v = kwargs[k]
+            alias, _, lookup = k.partition('__')
+            if lookup not in ('', 'gt', 'lt', 'gte', 'lte', 'range', 'in', 'isnull'):
+                raise QuerysetError('{} not allowed in annotations'.format(lookup))
+
+            if isinstance(self._annotations[alias], Window):
+                # filtered where it is already calculated, by its name
+                expression = '"{}"'.format(alias)
+            else:
+                expression, expression_values = self._aggregate_expression(self._annotations[alias], len(values))
+                values.extend(expression_values)
+            operator = LOOKUP_OPERATOR.get(lookup, '{t_n}.{k} = {v}').replace('{t_n}.{k}', expression)
+
+            if lookup == 'range':
+                if not isinstance(v, (tuple, list)) or len(v) != 2:
+                    raise QuerysetError('Not a correct tuple/list definition, should be of size 2')
+                condition = operator.format(min=placeholder(v[0]), max=placeholder(v[1]))
+            elif lookup == 'isnull':
+                condition = operator.format(v=v and 'IS NULL' or 'IS NOT NULL')
+            elif v is None:
+                condition = '{} IS NULL'.format(expression)
+            else:
+                condition = operator.format(v=placeholder(list(v) if lookup == 'in' else v))
+            filters.append(bool_string + condition)
+
+        return filters, values
+
     def exclude(self, **kwargs):
         return self.filter(exclude=True, **kwargs)
 
@@ -402,43 +1028,211 @@ class Queryset(object):
                 raise QuerysetError('{} is not a correct field for {}'.format(arg, self.model.__name__))
 
         queryset = self.queryset()
-        queryset.query = self.query_copy()
-        queryset.query[0]['select'] = ','.join(args)
+        queryset.query = self.query_copy().replace(select=','.join(args))
 
         return queryset
 
+    def _projection(self, fields):
+        # the fields requested (all of them by default), and how to recompose their values
+        if self._annotations:
+            raise QuerysetError('The fields have to be chosen before annotate')
+        if not fields:
+            fields = [f_n for f_n, f in self.model.fields.items() if not isinstance(f, ManyToManyField)]
+
+        t_n = self.model.table_name or self.model.__name__.lower()
+        columns, recompose = [], []
+        for index, field_name in enumerate(fields):
+            field = self.model.fields.get(field_name)
+            if field is None or isinstance(field, ManyToManyField):
+                raise QuerysetError('{} is not a correct field for {}'.format(field_name, self.model.__name__))
+
+            columns.append('{}.{}'.format(t_n, field.db_column))
+            if field.recompose_func is not None:
+                recompose.append((index, field.recompose_func))
+
+        queryset = self.queryset()
+        queryset.query = self.query_copy().replace(select=', '.join(columns))
+        return queryset, list(fields), recompose
+
+    def compact(self, lazy=False):
+        '''
+        The instances come without __dict__, with their attributes in __slots__
+        when lazy they keep the record and each attribute is decoded the first time it is read
+        '''
+        if self._annotations:
+            raise QuerysetError('The annotated querysets can not return compact instances')
+        # the models that can not have them fail now, not once iterated
+        self.model.compact_class()
+        queryset = self._copy_me()
+        queryset._compact = lazy and 'lazy' or 'slots'
+        return queryset
+
+    def values(self, *fields):
+        '''
+        Iterates over dicts of the fields requested (all by default) instead of model instances
+        only those columns are selected
+        '''
+        queryset, fields, recompose = self._projection(fields)
+        queryset._values = ('dict', fields, recompose, None)
+        queryset._row_parser = queryset._values_parser()
+        return queryset
+
+    def values_list(self, *fields, flat=False, named=False):
+        '''
+        Iterates over tuples of the fields requested (all by default) instead of model instances
+        named tuples when named, or the values themselves with flat and a single field
+        '''
+        if flat and named:
+            raise QuerysetError('flat and named can not be used together')
+        if flat and len(fields) != 1:
+            raise QuerysetError('flat is only allowed with a single field')
+
+        queryset, fields, recompose = self._projection(fields)
+        queryset._values = ('tuple', fields, recompose, flat and 'flat' or named and 'named' or None)
+        queryset._row_parser = queryset._values_parser()
+        return queryset
+
+    def _values_parser(self):
+        # the fields requested and then the annotations
+        kind, fields, recompose, option = self._values
+        names = list(fields) + list(self._annotations)
+        size = len(names)
+
+        if kind == 'dict':
+            def row_parser(record):
+                row = dict(zip(names, record.values()))
+                for index, func in recompose:
+                    row[names[index]] = func(row[names[index]])
+                return row
+            return row_parser
+
+        row_class = option == 'named' and namedtuple('Row', names) or tuple
+
+        def row_parser(record):
+            if option == 'flat':
+                if recompose:
+                    return recompose[0][1](record[0])
+                return record[0]
+
+            row = tuple(record.values())[:size]
+            if recompose:
+                row = list(row)
+                for index, func in recompose:
+                    row[index] = func(row[index])
+            return option == 'named' and row_class(*row) or tuple(row)
+        return row_parser
+
+    def group_by(self, *fields):
+        '''
+        The distinct groups of values of the fields, returned as values() dicts,
+        with the aggregates of each group when annotated
+        '''
+        if not fields:
+            raise QuerysetError('group_by requires the fields to group by')
+        queryset = self.values(*fields)
+        queryset.query = queryset.query.replace(
+            group_by=queryset._group_columns(), ordering=queryset._group_ordering())
+        return queryset
+
+    def _group_ordering(self):
+        # the rows are grouped, only the grouped fields can still order them
+        ordering = self.query_copy()[0].get('ordering') or []
+        if self._values is None:
+            return ordering
+        return [item for item in ordering if item.lstrip('-') in self._values[1]]
+
+    def _group_columns(self):
+        t_n = self.model.table_name or self.model.__name__.lower()
+        if self._values is None:
+            # each instance is a group
+            return ['{}.{}'.format(t_n, self.model.db_pk)]
+        return ['{}.{}'.format(t_n, self.model.fields[f].db_column) for f in self._values[1]]
+
+    def annotate(self, **aggregates):
+        '''
+        Adds the aggregates calculated for each group: the rows with the same values() /
+        group_by() fields, or each instance otherwise. The annotations can be filtered,
+        that becomes the HAVING of the GROUP BY, and ordered by their name
+        values('author').annotate(n=Count('id')).filter(n__gt=5).order_by('-n')
+        The Window annotations are calculated for each row and do not group them
+        annotate(rank=Window(RowNumber(), partition_by='author', order_by='-price')).filter(rank__lte=3)
+        '''
+        if not aggregates:
+            raise QuerysetError('annotate requires the aggregates to calculate')
+        if self.compact_mode:
+            raise QuerysetError('The annotated querysets can not return compact instances')
+        if self._values is not None and self._values[3] == 'flat':
+            raise QuerysetError('flat values_list can not be annotated')
+
+        annotations = OrderedDict(self._annotations)
+        for alias in sorted(aggregates):
+            self._check_alias(alias)
+            if alias in annotations or alias in self.model.fields:
+                raise QuerysetError('{} is already an attribute of {}'.format(alias, self.model.__name__))
+            annotations[alias] = aggregates[alias]
+
+        queryset = self._copy_me()
+        queryset._annotations = annotations
+        base = queryset.query[0]
+
+        # the select before any annotation
+        plain_select = base.get('plain_select', base['select'])
+        select = plain_select == '*' and '{}.*'.format(self.model.cls_tablename()) or plain_select
+
+        expressions, values = [], []
+        for alias, annotation in annotations.items():
+            expression, annotation_values = self._annotation_expression(annotation, len(values))
+            expressions.append('{} AS "{}"'.format(expression, alias))
+            values.extend(annotation_values)
+
+        select = ', '.join([select] + expressions)
+        queryset.query = queryset.query.replace(
+            select=select, plain_select=plain_select, field_values=values)
+
+        windows = [a for a in annotations.values() if isinstance(a, Window)]
+        if windows:
+            # the select the windows are filtered by, even once replaced (count, exists...)
+            queryset.query = queryset.query.replace(window_select=select)
+        if base.get('group_by') or len(windows) < len(annotations):
+            queryset.query = queryset.query.replace(
+                group_by=base.get('group_by') or queryset._group_columns(),
+                ordering=queryset._group_ordering(),
+            )
+        if queryset._values is not None:
+            queryset._row_parser = queryset._values_parser()
+        return queryset
+
     def order_by(self, *args):
         # retrieves from the database only the attrs requested
         # all the rest come as None
         final_args = []
         for arg in args:
-            if arg[0] == '-':
-                arg = arg[1:]
-                final_args.append('-' + arg)
             if arg == '?':
                 final_args.append('random()')
-            else:
-                final_args.append(arg)
-            if arg == '?':
                 continue
-            if not hasattr(self.model, arg):
-                raise QuerysetError('{} is not a correct field for {}'.format(arg, self.model.__name__))
+            field_name = arg[1:] if arg[0] == '-' else arg
+            if field_name in self._annotations:
+                final_args.append('{}"{}"'.format(arg[:-len(field_name)], field_name))
+                continue
+            if not hasattr(self.model, field_name):
+                raise QuerysetError('{} is not a correct field for {}'.format(
+                    field_name, self.model.__name__))
+            final_args.append(arg)
 
         queryset = self.queryset()
-        queryset.query = self.query_copy()
-        queryset.query[0]['ordering'] = final_args
+        queryset.query = self.query_copy().replace(ordering=final_args)
 
         return queryset
 
     # DB RELATED METHODS
     async def db_request(self, db_request):
-        db_request = deepcopy(db_request)
-        db_request[0].update({
-            'select': db_request[0].get('select', self.select),
-            'table_name': db_request[0].get(
-                'table_name', self.model.cls_tablename()
-            ),
-        })
+        if not isinstance(db_request, Query):
+            db_request = Query.from_nodes(db_request)
+        base = db_request[0]
+        db_request = db_request.replace(
+            select=base.get('select', self.select),
+            table_name=base.get('table_name', self.model.cls_tablename()),
+        )
         query = self.db_manager.construct_query(db_request)
         return await self.db_manager.request(query)
 
@@ -446,7 +1240,28 @@ class Queryset(object):
         queryset = Queryset(self.model)
         queryset.set_orm(self.orm)
         queryset.query = self.query_copy()
+        queryset._row_parser = self._row_parser
+        queryset._compact = self._compact
+        queryset._prefetch = self._prefetch
+        queryset._values = self._values
+        queryset._annotations = self._annotations
+        queryset._cursor_options = self._cursor_options
+
+        return queryset
+
+    def _slice(self, start, stop):
+        queryset = self._copy_me()
+        base = queryset.query[0]
 
+        limit, offset = base.get('limit'), base.get('offset') or 0
+        start = start or 0
+
+        new_limit = None if stop is None else max(stop - start, 0)
+        if limit is not None:
+            remaining = max(limit - start, 0)
+            new_limit = remaining if new_limit is None else min(new_limit, remaining)
+
+        queryset.query = queryset.query.replace(limit=new_limit, offset=offset + start)
         return queryset
 
     async def __getitem__(self, key):
@@ -459,33 +1274,23 @@ class Queryset(object):
             if key.step is not None:
                 raise QuerysetError('Step on Queryset is not allowed')
 
-            # asign forward and stop to the modelmanager and return it
-            self.forward = key.start
-            self.stop = key.stop
-            if key.start is None:
-                self.forward = 0
-            return self
+            # the slice ends up as LIMIT / OFFSET in the query
+            return self._slice(key.start, key.stop)
 
         elif isinstance(key, int):
             # if its an int, the developer wants the object directly
             if key < 0:
                 raise QuerysetError('Negative indices are not allowed')
 
-            cursor = self._cursor
-            if not cursor:
-                query = self.db_manager.construct_query(self.query)
-                logger.debug('QUERY: {}'.format(query))
-                cursor = Cursor(
-                    self.db_manager.pool,
-                    query[0],
-                    values=query[1],
-                    forward=key,
-                )
-
-            async for res in cursor:
-                item = self.modelconstructor(res)
-                return item
-            raise IndexError('That {} index does not exist'.format(self.model.__name__))
+            queryset = self._slice(key, key + 1)
+            query = self.db_manager.construct_query(queryset.query)
+            results = await self.db_manager.fetch(query)
+            if not results:
+                raise IndexError('That {} index does not exist'.format(self.model.__name__))
+            queryset._sql = query[0]
+            result = queryset.build_result(results[0])
+            await queryset._prefetch_related([result])
+            return result
 
         else:
             raise TypeError("Invalid argument type.")
@@ -494,21 +1299,43 @@ class Queryset(object):
         return self
 
     async def __anext__(self):
-        if not self._cursor:
-            query = self.db_manager.construct_query(self.query)
-            logger.debug('QUERY: {}'.format(query))
-            self._cursor = Cursor(
-                self.db_manager.pool,
-                query[0],
-                values=query[1],
-                forward=self.forward,
-                stop=self.stop,
-            )
+        if self._cursor is None and self._results is None:
+            query_chain = self.query or self.basic_query
+            query = self.db_manager.construct_query(query_chain)
+            self._sql = query[0]
+
+            limit = query_chain[0].get('limit')
+            if self._prefetch:
+                # the related objects are loaded for all the results at once
+                _, results = await self._fetch_all()
+                self._results = deque(results)
+            elif limit is not None and limit <= self.fetch_limit:
+                # small slices come back in a single round trip
+                self._results = deque([self.build_result(r) for r in await self.db_manager.fetch(query)])
+            else:
+                self._cursor = Cursor(
+                    self.db_manager.pool,
+                    query[0],
+                    values=query[1],
+                    prepare=self.db_manager.prepare,
+                    **self._cursor_options
+                )
+
+        if self._results is not None:
+            if self._results:
+                return self._results.popleft()
+            raise StopAsyncIteration()
+
         async for rec in self._cursor:
-            item = self.modelconstructor(rec)
+            item = self.build_result(rec)
             return item
         raise StopAsyncIteration()
 
+    async def aclose(self):
+        '''gives back the connection held by an iteration that was not exhausted'''
+        if self._cursor:
+            await self._cursor.aclose()
+
 
 class ModelManager(Queryset):
 
@@ -517,19 +1344,136 @@ class ModelManager(Queryset):
         self.field = field
         super().__init__(model)
 
-    async def get_or_create(self, **kwargs):
+    async def get_or_create(self, defaults=None, **kwargs):
+        '''
+        Returns (instance, created), the one matching the kwargs or a new one with the kwargs
+        and defaults: looked up and inserted in a single statement, that does nothing if
+        a concurrent one inserts it first
+        '''
+        if not kwargs:
+            raise QuerysetError('get_or_create requires the fields to look up')
+        if self.model.orm_pk in kwargs:
+            # the primary keys can not be forced, so it can only be found
+            try:
+                return await self.get(**kwargs), False
+            except ModelDoesNotExist:
+                return await self.create(**kwargs), True
+
+        filters, values = self.calc_filters(kwargs, False)
+        instance, fields, field_data = self._upsert_data(kwargs, defaults)
+
+        offset = len(values)
+        query = self.db_manager.construct_query([{
+            'action': 'db__get_or_insert',
+            'table_name': self.model.cls_tablename(),
+            'condition': ' AND '.join(filters),
+            'field_names': ', '.join(fields),
+            'field_schema': ', '.join(['${}'.format(offset + i + 1) for i in range(len(fields))]),
+            'field_values': values + field_data,
+        }])
+        try:
+            records = await self.db_manager.fetch(query)
+        except UniqueViolationError:
+            raise ModelError('The model violates a unique constraint')
+
+        if not records:
+            # inserted by a transaction that was not committed yet when the statement started
+            try:
+                return await self.get(**kwargs), False
+            except ModelDoesNotExist:
+                raise ModelError('The model violates a unique constraint')
+
+        if not records[0]['_created']:
+            return self.modelconstructor(records[0]), False
+
+        self.modelconstructor(records[0], instance)
+        await self._save_m2m(instance)
+        return instance, True
+
+    async def update_or_create(self, defaults=None, **kwargs):
+        '''
+        Returns (instance, created), the one matching the kwargs updated with the defaults
+        or a new one with both. When the kwargs include a unique field (or the unique_together)
+        it is a single INSERT ... ON CONFLICT DO UPDATE, otherwise it is looked up and saved
+        '''
+        target = self._conflict_target(kwargs)
+        if not defaults or target is None:
+            instance, created = await self.get_or_create(defaults=defaults, **kwargs)
+            if defaults and not created:
+                for field_name, value in defaults.items():
+                    setattr(instance, field_name, value)
+                await self.save(instance)
+            return instance, created
+
+        instance, fields, field_data = self._upsert_data(kwargs, defaults)
+        named = [self.model.fields[f].db_column for f in list(kwargs) + list(defaults)]
+        update_columns = [f for f in fields if f in named and f not in target]
+        if not update_columns:
+            return await self.get_or_create(defaults=defaults, **kwargs)
+
+        query = self.db_manager.construct_query([{
+            'action': 'db__upsert',
+            'table_name': self.model.cls_tablename(),
+            'field_names': ', '.join(fields),
+            'field_schema': ', '.join(['${}'.format(i + 1) for i in range(len(fields))]),
+            'field_values': field_data,
+            'conflict_fields': ', '.join(target),
+            'update_schema': ', '.join(['{0} = EXCLUDED.{0}'.format(f) for f in update_columns]),
+        }])
         try:
-            return await self.get(**kwargs), False
-        except ModelDoesNotExist:
-            return await self.create(**kwargs), True
+            record = await self.db_manager.request(query)
+        except UniqueViolationError:
+            raise ModelError('The model violates a unique constraint')
 
-    async def save(self, instanced_model, update_fields=None):
-        # performs the database save
+        self.modelconstructor(record, instance)
+        await self._save_m2m(instance)
+        return instance, record['_created']
+
+    def _conflict_target(self, field_names):
+        # the columns of a unique constraint among the fields, what ON CONFLICT checks
+        columns = []
+        for field_name in sorted(field_names):
+            field = self.model.fields.get(field_name)
+            if field is None or isinstance(field, ManyToManyField):
+                continue
+            if field.unique and field_name != self.model.orm_pk:
+                return [field.db_column]
+            columns.append(field.db_column)
+
+        unique_together = self.model.unique_together
+        if unique_together and all(c in columns for c in unique_together):
+            return list(unique_together)
+        return None
+
+    def _upsert_data(self, kwargs, defaults):
+        # the new instance with the kwargs and defaults, all of them are part of the insert
+        values = dict(defaults or {})
+        values.update(kwargs)
+        instance = self.model(**values)
+
+        model_fields = []
+        for field_name in sorted(values):
+            field = self.model.fields[field_name]
+            if not isinstance(field, ManyToManyField):
+                model_fields.append(field)
+        fields, field_data = self._db_data_with(instance, model_fields)
+        return instance, fields, field_data
+
+    def _db_data(self, instanced_model, update_fields=None):
+        # the db columns and sanitized values to be saved
         fields, field_data = [], []
+        if update_fields:
+            # those fields exactly as they are now, even when null or the default
+            for f_n in update_fields:
+                field = instanced_model.fields.get(f_n)
+                if field is None or isinstance(field, ManyToManyField) or f_n == instanced_model.orm_pk:
+                    continue
+                value = getattr(instanced_model, f_n)
+                fields.append(field.db_column or f_n)
+                field_data.append(value if value is None else field.sanitize_data(value))
+            return fields, field_data
 
         for k, data in instanced_model.data.items():
-            if update_fields and k not in update_fields:
-                continue
             f_class = getattr(instanced_model.__class__, k)
             field_name = f_class.db_column or k
 
@@ -539,8 +1483,6 @@ class ModelManager(Queryset):
             field_data.append(data)
 
         for field in instanced_model.fields.keys():
-            if update_fields and field not in update_fields:
-                continue
             if field not in fields:
                 f_class = getattr(instanced_model.__class__, field)
 
@@ -556,20 +1498,36 @@ class ModelManager(Queryset):
 
                     fields.append(field_name)
                     field_data.append(data)
+        return fields, field_data
+
+    def _db_data_with(self, instanced_model, model_fields):
+        # the data to be saved, always including those fields, even when they are null
+        fields, field_data = self._db_data(instanced_model)
+        for field in model_fields:
+            if field.db_column not in fields:
+                value = getattr(instanced_model, field.orm_field_name)
+                fields.append(field.db_column)
+                field_data.append(value if value is None else field.sanitize_data(value))
+        return fields, field_data
 
+    async def save(self, instanced_model, update_fields=None):
+        # performs the database save
+        pk_value = getattr(instanced_model, instanced_model.orm_pk)
+        if pk_value and update_fields is None:
+            # only what changed since it was loaded, if anything
+            update_fields = instanced_model.dirty_fields
+
+        if update_fields is not None and not update_fields:
+            await self._save_m2m(instanced_model)
+            return
+
+        fields, field_data = self._db_data(instanced_model, update_fields)
         db_request = [{
-            'action': getattr(instanced_model, instanced_model.orm_pk) and 'db__update' or 'db__insert',
-            'id_data': '{}={}'.format(
-                instanced_model.db_pk,
-                getattr(instanced_model, instanced_model.orm_pk),
-            ),
+            'action': pk_value and 'db__update' or 'db__insert',
+            'id_data': '{}=${}'.format(instanced_model.db_pk, len(field_data) + 1),
             'field_names': ', '.join(fields),
-            'field_values': field_data,
+            'field_values': pk_value and field_data + [pk_value] or field_data,
             'field_schema': ', '.join(['${}'.format(value + 1) for value in range(len(field_data))]),
-            'condition': '{}={}'.format(
-                instanced_model.db_pk,
-                getattr(instanced_model, instanced_model.orm_pk)
-            )
         }]
         try:
             response = await self.db_request(db_request)
@@ -577,47 +1535,302 @@ class ModelManager(Queryset):
             raise ModelError('The model violates a unique constraint')
 
         self.modelconstructor(response, instanced_model)
+        await self._save_m2m(instanced_model)
 
-        # now we have to save the m2m relations: m2m_data
-        fields, field_data = [], []
+    async def _save_m2m(self, instanced_model):
+        # the m2m relations: m2m_data, they end up being exactly the ones in the field
         for k, data in instanced_model.m2m_data.items():
-            # for each of the m2m fields in the model, we have to check
-            # if the table register already exists in the table otherwise
-            # and delete the ones that are not in the list
-            # first get the table_name
-            cls_field = getattr(instanced_model.__class__, k)
-            table_name = cls_field.table_name
-            foreign_column = cls_field.foreign_key
-
-            model_column = instanced_model.cls_tablename()
-
-            model_id = getattr(instanced_model, instanced_model.orm_pk)
-
-            db_request = [{
-                'table_name': table_name,
-                'action': 'db__insert',
-                'field_names': ', '.join([model_column, foreign_column]),
-                'field_values': [model_id, data],
-                'field_schema': ', '.join(
-                    ['${}'.format(value + 1) for value in range(len([model_id, data]))]),
-            }]
+            await self.set_m2m(instanced_model, k, data)
 
-            if isinstance(data, list):
-                for d in data:
-                    db_request[0].update({'field_values': [model_id, d],
-                                          'field_schema': ', '.join(['${}'.format(value + 1) for value in
-                                                                     range(len([model_id, d]))])})
-                    await self.db_request(db_request)
-            else:
-                await self.db_request(db_request)
+    def _m2m_field(self, field_name):
+        field = self.model.fields.get(field_name)
+        if not isinstance(field, ManyToManyField):
+            raise QuerysetError('{} is not a ManyToManyField for {}'.format(field_name, self.model.__name__))
+        return field
+
+    @staticmethod
+    def _m2m_ids(ids):
+        # the ids or the instances themselves, without repetitions
+        if not isinstance(ids, (list, tuple)):
+            ids = [ids]
+
+        result = []
+        for i in ids:
+            if hasattr(i, 'orm_pk'):
+                i = getattr(i, i.orm_pk)
+            if i not in result:
+                result.append(i)
+        return result
+
+    def _m2m_query(self, action, field, field_values):
+        return self.db_manager.construct_query([{
+            'action': action,
+            'm2m_tablename': field.table_name,
+            'my_column': field.own_model,
+            'other_column': field.foreign_key,
+            'field_values': field_values,
+        }])
+
+    async def _m2m_change(self, conn, action, field, model_id, ids):
+        if not ids:
+            return 0
+        status = await self.db_manager.execute_query(
+            conn, 'execute', *self._m2m_query(action, field, [model_id, ids]))
+        return int(status.split()[-1])
+
+    async def add_m2m(self, instanced_model, field_name, ids):
+        '''relates the ids in a single INSERT, the ones already related are skipped'''
+        field = self._m2m_field(field_name)
+        ids = self._m2m_ids(ids)
+        model_id = getattr(instanced_model, instanced_model.orm_pk)
+
+        async with self.db_manager.pool.acquire() as conn:
+            added = await self._m2m_change(conn, 'db__m2m_add', field, model_id, ids)
+
+        current = getattr(instanced_model, field_name)
+        if isinstance(current, list):
+            setattr(instanced_model, field_name, current + [i for i in ids if i not in current])
+        return added
+
+    async def remove_m2m(self, instanced_model, field_name, ids):
+        '''removes the relations with the ids in a single DELETE'''
+        field = self._m2m_field(field_name)
+        ids = self._m2m_ids(ids)
+        model_id = getattr(instanced_model, instanced_model.orm_pk)
+
+        async with self.db_manager.pool.acquire() as conn:
+            removed = await self._m2m_change(conn, 'db__m2m_remove', field, model_id, ids)
+
+        current = getattr(instanced_model, field_name)
+        if isinstance(current, list):
+            setattr(instanced_model, field_name, [i for i in current if i not in ids])
+        return removed
+
+    async def set_m2m(self, instanced_model, field_name, ids):
+        '''
+        The relations become exactly the ids: the existing ones are read in one query
+        and only the differences are inserted and deleted, in the same transaction
+        '''
+        field = self._m2m_field(field_name)
+        ids = self._m2m_ids(ids)
+        model_id = getattr(instanced_model, instanced_model.orm_pk)
+
+        async with self.db_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                records = await self.db_manager.execute_query(
+                    conn, 'fetch', *self._m2m_query('db__m2m_select', field, [model_id]))
+                existing = {r[0] for r in records}
+
+                await self._m2m_change(
+                    conn, 'db__m2m_add', field, model_id, [i for i in ids if i not in existing])
+                await self._m2m_change(
+                    conn, 'db__m2m_remove', field, model_id, [i for i in existing if i not in ids])
+
+        setattr(instanced_model, field_name, ids)
+
+    async def bulk_create(self, instances, batch_size=1000, returning=False):
+        '''
+        Inserts the instances in batches of batch_size rows, all in the same transaction
+        The rows are sent with COPY, unless returning is requested: then a multi row
+        INSERT ... RETURNING is used and the instances get back their pk and db defaults
+        The many to many relations are not saved.
+        '''
+        if batch_size <= 0:
+            raise QuerysetError('batch_size should be a positive integer')
+
+        # instances with different columns set can not be inserted together
+        groups = OrderedDict()
+        for instance in instances:
+            fields, field_data = self._db_data(instance)
+            groups.setdefault(tuple(fields), []).append((instance, field_data))
+
+        db_manager = self.db_manager
+        table_name = self.model.cls_tablename()
+        async with db_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                for fields, rows in groups.items():
+                    size = min(batch_size, db_manager.max_parameters // max(len(fields), 1))
+
+                    for start in range(0, len(rows), size):
+                        batch = rows[start:start + size]
+                        try:
+                            if returning:
+                                records = await db_manager.execute_query(
+                                    conn, 'fetch', *self._insert_many_query(fields, batch))
+                                # the rows come back in the same order they were sent
+                                for (instance, _), record in zip(batch, records):
+                                    self.modelconstructor(record, instance)
+                            else:
+                                await db_manager.copy_records(
+                                    conn, table_name, fields, [field_data for _, field_data in batch])
+                        except UniqueViolationError:
+                            raise ModelError('The model violates a unique constraint')
+        return instances
+
+    async def bulk_upsert(self, instances, conflict_fields, update_fields=None, batch_size=1000):
+        '''
+        Inserts the instances, those conflicting on conflict_fields (a unique constraint)
+        with a row already in the table update its update_fields instead, or are skipped
+        when there are none. A multi row INSERT ... ON CONFLICT for each batch, all in the
+        same transaction, the instances inserted or updated get back their pk and db values
+        The many to many relations are not saved.
+        '''
+        if batch_size <= 0:
+            raise QuerysetError('batch_size should be a positive integer')
+        if not conflict_fields:
+            raise QuerysetError('bulk_upsert requires the conflict fields')
+
+        conflict, update = [], []
+        for field_names, model_fields in ((conflict_fields, conflict), (update_fields or [], update)):
+            for field_name in field_names:
+                field = self.model.fields.get(field_name)
+                if field is None:
+                    raise QuerysetError('{} is not a correct field for {}'.format(field_name, self.model.__name__))
+                if isinstance(field, (AutoField, ManyToManyField)):
+                    raise QuerysetError('{} field can not be upserted'.format(field_name))
+                model_fields.append(field)
+
+        conflict_clause = {
+            'conflict_fields': ', '.join([f.db_column for f in conflict]),
+            'conflict_action': update and 'DO UPDATE SET {}'.format(', '.join([
+                '{0} = EXCLUDED.{0}'.format(f.db_column) for f in update
+            ])) or 'DO NOTHING',
+        }
+
+        # the same row can not be upserted twice in a statement, the last instance wins
+        groups, by_key = OrderedDict(), {}
+        for instance in instances:
+            fields, field_data = self._db_data_with(instance, conflict + update)
+            key = tuple(getattr(instance, f.orm_field_name) for f in conflict)
+            groups.setdefault(tuple(fields), OrderedDict())[key] = (instance, field_data)
+            by_key.setdefault(key, []).append(instance)
+
+        db_manager = self.db_manager
+        async with db_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                for fields, rows in groups.items():
+                    rows = list(rows.values())
+                    size = min(batch_size, db_manager.max_parameters // max(len(fields), 1))
+
+                    for start in range(0, len(rows), size):
+                        query = self._insert_many_query(fields, rows[start:start + size], conflict_clause)
+                        try:
+                            records = await db_manager.execute_query(conn, 'fetch', *query)
+                        except UniqueViolationError:
+                            raise ModelError('The model violates a unique constraint')
+                        except InvalidColumnReferenceError:
+                            raise QuerysetError('The conflict fields have to be a unique constraint')
+
+                        # the skipped rows do not come back, the records are matched by their key
+                        for record in records:
+                            for instance in by_key.get(self._record_key(record, conflict), ()):
+                                self.modelconstructor(record, instance)
+        return instances
+
+    @staticmethod
+    def _record_key(record, model_fields):
+        key = []
+        for field in model_fields:
+            value = record[field.db_column]
+            if value is not None and field.recompose_func is not None:
+                value = field.recompose_func(value)
+            key.append(value)
+        return tuple(key)
+
+    def _insert_many_query(self, fields, batch, conflict_clause=None):
+        n_fields = len(fields)
+        return self.db_manager.construct_query([dict(conflict_clause or {}, **{
+            'action': conflict_clause and 'db__upsert_many' or 'db__insert_many',
+            'table_name': self.model.cls_tablename(),
+            'field_names': ', '.join(fields),
+            'field_schema': ', '.join([
+                '({})'.format(', '.join(['${}'.format(row * n_fields + i + 1) for i in range(n_fields)]))
+                for row in range(len(batch))
+            ]),
+            'field_values': [value for _, field_data in batch for value in field_data],
+        })])
+
+    async def bulk_update(self, instances, fields, batch_size=1000):
+        '''
+        Saves the fields of the instances, one UPDATE ... FROM unnest(...) for each
+        batch of batch_size instances, all in the same transaction
+        Returns the number of rows updated
+        '''
+        if batch_size <= 0:
+            raise QuerysetError('batch_size should be a positive integer')
+        if not fields:
+            raise QuerysetError('bulk_update requires the fields to update')
+
+        model_fields = []
+        for field_name in fields:
+            field = self.model.fields.get(field_name)
+            if field is None:
+                raise QuerysetError('{} is not a correct field for {}'.format(field_name, self.model.__name__))
+            # the arrays are unnested, so array values would be flattened
+            if isinstance(field, (AutoField, ManyToManyField, ArrayField)):
+                raise QuerysetError('{} field can not be bulk updated'.format(field_name))
+            model_fields.append(field)
+
+        pk_field = self.model.fields[self.model.orm_pk]
+        columns = [pk_field] + model_fields
+        db_request = [{
+            'action': 'db__update_many',
+            'table_name': self.model.cls_tablename(),
+            'db_pk': self.model.db_pk,
+            'field_names': ', '.join([f.db_column for f in columns]),
+            'field_schema': ', '.join(['{0} = bulk_data.{0}'.format(f.db_column) for f in model_fields]),
+            'unnest_schema': ', '.join([
+                '${}::{}[]'.format(i + 1, f.db_type) for i, f in enumerate(columns)
+            ]),
+        }]
+
+        rows, by_pk = [], {}
+        for instance in instances:
+            pk_value = getattr(instance, self.model.orm_pk)
+            if not pk_value:
+                raise ModelError('The {} instances have to be saved before'.format(self.model.__name__))
+            values = [getattr(instance, f.orm_field_name) for f in model_fields]
+            rows.append([pk_value] + [
+                value if value is None else f.sanitize_data(value) for f, value in zip(model_fields, values)
+            ])
+            by_pk.setdefault(pk_value, []).append(instance)
+
+        records = []
+        db_manager = self.db_manager
+        async with db_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                for start in range(0, len(rows), batch_size):
+                    # one array for each column
+                    db_request[0]['field_values'] = [list(c) for c in zip(*rows[start:start + batch_size])]
+                    try:
+                        records.extend(await db_manager.execute_query(
+                            conn, 'fetch', *db_manager.construct_query(db_request)))
+                    except UniqueViolationError:
+                        raise ModelError('The model violates a unique constraint')
+
+        # once committed, the updated rows are the snapshot the instances are dirty against
+        # their values are kept, so the changes to the other fields are still saved later
+        column_map = None
+        for record in records:
+            if column_map is None:
+                column_map = {
+                    name: (position, recompose)
+                    for position, name, recompose in self.model.column_decoders(enumerate(record.keys()))
+                }
+            for instance in by_pk.get(record[self.model.db_pk], ()):
+                instance._record = record
+                instance._columns = column_map
+        return len(records)
+
+    async def delete(self, instanced_model=None):
+        if instanced_model is None:
+            # the whole table is only deleted on purpose, with all().delete()
+            raise QuerysetError('delete requires the instance to delete')
 
-    async def delete(self, instanced_model):
         db_request = [{
             'action': 'db__delete',
-            'id_data': '{}={}'.format(
-                instanced_model.db_pk,
-                getattr(instanced_model, instanced_model.db_pk)
-            )
+            'id_data': '{}=$1'.format(instanced_model.db_pk),
+            'field_values': [getattr(instanced_model, instanced_model.orm_pk)],
         }]
         return await self.db_request(db_request)
 
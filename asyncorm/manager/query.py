@@ -0,0 +1,77 @@
+from asyncorm.database.db_manager import GeneralManager, freeze
+
+__all__ = ['Query']
+
+
+def node_shape(node):
+    return tuple(sorted(
+        (k, freeze(v)) for k, v in node.items() if k not in GeneralManager.value_keys
+    ))
+
+
+class QueryLink(object):
+    '''a chained node pointing to the ones chained before it, shared between querysets'''
+    __slots__ = ('node', 'parent', 'shape', 'length')
+
+    def __init__(self, node, parent=None):
+        self.node = node
+        self.parent = parent
+        self.shape = (parent and parent.shape, node_shape(node))
+        self.length = parent and parent.length + 1 or 1
+
+
+class Query(object):
+    '''
+    Immutable query chain, the base node plus the chained ones (where, select_related...)
+    Adding a node or replacing the base returns a new Query that shares everything
+    else with the original, so chaining querysets costs the same whatever its length.
+    The nodes are plain dicts that are never modified once in a Query.
+    '''
+    __slots__ = ('base', 'tail', '_shape')
+
+    def __init__(self, base, tail=None):
+        self.base = base
+        self.tail = tail
+        self._shape = None
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        query = cls(nodes[0])
+        for node in nodes[1:]:
+            query = query.add(node)
+        return query
+
+    def add(self, node):
+        '''new query with the node chained at the end'''
+        return Query(self.base, QueryLink(node, self.tail))
+
+    def replace(self, **kwargs):
+        '''new query with the base updated with the kwargs'''
+        base = dict(self.base)
+        base.update(kwargs)
+        return Query(base, self.tail)
+
+    @property
+    def shape(self):
+        '''structure of the chain without the values, the key of the compiled sql'''
+        if self._shape is None:
+            self._shape = (node_shape(self.base), self.tail and self.tail.shape)
+        return self._shape
+
+    def __getitem__(self, index):
+        # the base is what the querysets look at, the rest is walked by the iteration
+        if index == 0:
+            return self.base
+        return list(self)[index]
+
+    def __iter__(self):
+        nodes, link = [], self.tail
+        while link is not None:
+            nodes.append(link.node)
+            link = link.parent
+
+        yield self.base
+        yield from reversed(nodes)
+
+    def __len__(self):
+        return self.tail and self.tail.length + 1 or 1
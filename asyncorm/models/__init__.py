@@ -1,3 +1,4 @@
+from asyncorm.manager.aggregates import Avg, Count, DenseRank, Max, Min, Rank, RowNumber, StdDev, Sum, Window
 from asyncorm.models.fields import (
     ArrayField,
     AutoField,
@@ -29,5 +30,7 @@ __all__ = (
     'DateField', 'DateTimeField', 'DecimalField', 'EmailField', 'Field',
     'ForeignKey', 'GenericIPAddressField', 'IntegerField', 'JsonField',
     'MACAdressField', 'ManyToManyField', 'Model', 'NumberField', 'TextField',
-    'TimeField', 'Uuid4Field', 'FloatField', 'BigAutoField'
+    'TimeField', 'Uuid4Field', 'FloatField', 'BigAutoField',
+    'Avg', 'Count', 'Max', 'Min', 'StdDev', 'Sum',
+    'DenseRank', 'Rank', 'RowNumber', 'Window',
 )
@@ -85,6 +85,11 @@ class Field(object):
 
         return creation_string.format(**self.__dict__)
 
+    @property
+    def db_type(self):
+        '''sql type of the column, to cast the values sent together in arrays'''
+        return self.creation_string.format(**self.__dict__)
+
     def validate_kwargs(self, kwargs):
         for kw in self.required_kwargs:
             if not kwargs.get(kw, None):
@@ -118,6 +123,13 @@ class Field(object):
     def recompose(cls, value):
         return value
 
+    @property
+    def recompose_func(self):
+        '''the recompose of the field, None when it leaves the values untouched'''
+        if getattr(self.recompose, '__func__', None) is Field.recompose.__func__:
+            return None
+        return self.recompose
+
     def sanitize_data(self, value):
         '''method used to convert python to SQL data'''
         self.validate(value)
@@ -263,6 +275,7 @@ class DecimalField(NumberField):
 # Auto fields
 class AutoField(IntegerField):
     creation_string = 'serial PRIMARY KEY'
+    db_type = 'integer'
     args = ('choices', 'db_column', 'db_index', 'default', 'null', 'unique',)
 
     def __init__(self, db_column='id'):
@@ -271,6 +284,7 @@ class AutoField(IntegerField):
 
 class BigAutoField(BigIntegerField):
     creation_string = 'serial PRIMARY KEY'
+    db_type = 'bigint'
     args = ('choices', 'db_column', 'db_index', 'default', 'null', 'unique',)
 
     def __init__(self, db_column='id'):
@@ -313,6 +327,7 @@ class ForeignKey(Field):
     internal_type = int
     required_kwargs = ['foreign_key', ]
     creation_string = 'integer references {foreign_key}'
+    db_type = 'integer'
     args = ('db_column', 'db_index', 'default', 'foreign_key', 'null', 'unique')
 
     def __init__(self, db_column='', db_index=False, default=None, foreign_key='', null=False, unique=False):
@@ -326,7 +341,8 @@ class ManyToManyField(Field):
     required_kwargs = ['foreign_key', ]
     creation_string = '''
         {own_model} INTEGER REFERENCES {own_model} NOT NULL,
-        {foreign_key} INTEGER REFERENCES {foreign_key} NOT NULL
+        {foreign_key} INTEGER REFERENCES {foreign_key} NOT NULL,
+        UNIQUE ({own_model}, {foreign_key})
     '''
     args = ('db_column', 'db_index', 'default', 'foreign_key', 'unique')
 
@@ -384,6 +400,7 @@ class JsonField(Field):
 
 class Uuid4Field(Field):
     internal_type = UUID
+    db_type = 'uuid'
     args = ('db_column', 'db_index', 'null', 'unique', 'uuid_type',)
 
     def __init__(self, db_column='', db_index=False, null=False, unique=True, uuid_type='v4'):
@@ -1,5 +1,7 @@
 import inspect
 import os
+from collections import deque
+from copy import deepcopy
 
 from asyncorm.application.configure import get_model
 from asyncorm.exceptions import FieldError, ModelDoesNotExist, ModelError
@@ -10,8 +12,24 @@ from asyncorm.serializers import ModelSerializer, SerializerMethod
 __all__ = ['Model', 'ModelSerializer', 'SerializerMethod']
 
 
+def decoded(value, recompose):
+    # the instances get their own copy of lists and dicts, the record keeps what was loaded
+    if recompose:
+        return recompose(value)
+    if isinstance(value, (list, dict)):
+        return deepcopy(value)
+    return value
+
+
 class ModelMeta(type):
 
+    def __instancecheck__(cls, instance):
+        # the compact instances are also instances of the model they were generated from
+        compact_of = getattr(type(instance), '_compact_of', None)
+        if compact_of is not None:
+            return issubclass(compact_of, cls)
+        return super().__instancecheck__(instance)
+
     def __new__(cls, clsname, bases, clsdict):
         base_class = super().__new__(cls, clsname, bases, clsdict)
 
@@ -27,6 +45,7 @@ class ModelMeta(type):
         base_class.ordering = None
         base_class.unique_together = []
         base_class.table_name = ''
+        base_class.compact = False
         base_class.DoesNotExist = ModelDoesNotExist
         base_class.meta_items = ('ordering', 'unique_together', 'table_name')
 
@@ -37,6 +56,8 @@ class ModelMeta(type):
                 base_class.unique_together = getattr(defined_meta, 'unique_together')
             if hasattr(defined_meta, 'table_name'):
                 base_class.table_name = getattr(defined_meta, 'table_name')
+            if hasattr(defined_meta, 'compact'):
+                base_class.compact = getattr(defined_meta, 'compact')
 
         base_class.fields = base_class.get_fields()
 
@@ -51,13 +72,141 @@ class ModelMeta(type):
             base_class.db_pk = primary_keys[0].db_column
             base_class.orm_pk = primary_keys[0].orm_field_name
 
+        # the display of the choices, a method shared by all the instances
         for f in base_class.fields.values():
             if hasattr(f, 'choices'):
                 if f.choices:
-                    setattr(base_class, '{}_display'.format(f.orm_field_name), 'choices_placeholder')
+                    setattr(base_class, '{}_display'.format(f.orm_field_name), choices_display(f))
+
+        # the initial value of each attribute, so instances do not have to look for them
+        base_class._field_defaults = {
+            f_n: getattr(f, 'default', None) for f_n, f in base_class.fields.items()
+        }
+
+        # where the model is declared, only once per class
+        module = inspect.getmodule(base_class)
+        if module is not None and getattr(module, '__file__', None):
+            base_class.dir_name = os.path.dirname(module.__file__)
+            if 'app_name' not in base_class.fields:
+                base_class.app_name = base_class.dir_name.split(os.path.sep)[-1]
         return base_class
 
 
+class CompactField(object):
+    '''
+    Attribute of the compact instances, kept in a slot
+    It is decoded from the record the first time it is read, when the instance is record
+    backed, and accessed from the class it returns the Field, like in the models
+    '''
+    __slots__ = ('name', 'field', 'slot', 'default')
+
+    def __init__(self, name, field, slot, default):
+        self.name = name
+        self.field = field
+        self.slot = slot
+        self.default = default
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.field
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            pass
+
+        value = self.default
+        columns = instance._columns
+        if columns is not None and self.name in columns:
+            position, recompose = columns[self.name]
+            value = decoded(instance._record[position], recompose)
+        self.slot.__set__(instance, value)
+        return value
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+
+def compact_init(self, **kwargs):
+    self.validate_kwargs(kwargs)
+    self._record = self._columns = None
+    self.deleted = False
+    for k, v in kwargs.items():
+        setattr(self, k, v)
+
+
+@classmethod
+def compact_from_db(cls):
+    instance = cls.__new__(cls)
+    instance._record = instance._columns = None
+    return instance
+
+
+def uses_super(klass):
+    # super() (and __class__) bind a method to the class it was defined in
+    for value in vars(klass).values():
+        for func in (value, getattr(value, '__func__', None), getattr(value, 'fget', None)):
+            code = getattr(func, '__code__', None)
+            if code is not None and '__class__' in code.co_freevars:
+                return True
+    return False
+
+
+def compact_class(model):
+    '''
+    Generates the version of the model without __dict__, its attributes live in __slots__
+    it has the same methods and class attributes, and passes the isinstance checks
+    It is not a subclass of the model, so the models whose methods use super() can not have it
+    '''
+    if any(uses_super(klass) for klass in model.__mro__[:-1]):
+        raise ModelError('{} methods use super(), it can not have compact instances'.format(model.__name__))
+
+    slots = ['_record', '_columns', '_prefetched', 'deleted'] + ['_slot_{}'.format(f_n) for f_n in model.fields]
+
+    namespace = {}
+    for klass in reversed(model.__mro__[:-1]):
+        namespace.update(vars(klass))
+    for name in ['__dict__', '__weakref__', '_compact_class'] + slots + list(model.fields):
+        namespace.pop(name, None)
+
+    namespace.update({
+        '__slots__': tuple(slots),
+        '__init__': compact_init,
+        '_from_db': compact_from_db,
+        '_compact_of': model,
+    })
+    compact = type(model.__name__, (object, ), namespace)
+
+    for f_n, field in model.fields.items():
+        slot = compact.__dict__['_slot_{}'.format(f_n)]
+        setattr(compact, f_n, CompactField(f_n, field, slot, model._field_defaults[f_n]))
+    return compact
+
+
+def related_set(accessor, queryset_builder, relation):
+    '''
+    The accessor of the related objects, its queryset comes with them
+    without querying the database when they were loaded by prefetch_related
+    '''
+    def related(self):
+        queryset = queryset_builder(self)
+        prefetched = getattr(self, '_prefetched', None) or {}
+        if accessor in prefetched:
+            queryset._results = deque(prefetched[accessor])
+        return queryset
+
+    related.relation = relation
+    return related
+
+
+def choices_display(field):
+    def display(self):
+        value = getattr(self, field.orm_field_name)
+        for a, b in field.choices.items():
+            if a == value:
+                return b
+    return display
+
+
 class BaseModel(object, metaclass=ModelMeta):
     table_name = ''
 
@@ -65,42 +214,33 @@ class BaseModel(object, metaclass=ModelMeta):
     deleted = False
     field_requirements = []
 
-    def __init__(self, **kwargs):
-        self.dir_name = os.path.dirname(inspect.getmodule(self).__file__)
-        self.app_name = self.dir_name.split(os.path.sep)[-1]
-
-        self.table_name = ''
+    # the record the instance was loaded from, and where its fields are in it
+    _record = None
+    _columns = None
+    # the related objects loaded by prefetch_related, by accessor
+    _prefetched = None
 
-        self.objects.model = self.__class__
-
-        manager = getattr(self, 'objects')
-        manager.model = self.__class__
-
-        # resolve method for posible display methods
-        for k, v in self.__class__.__dict__.items():
-            if v == 'choices_placeholder':
-                field_name = k.split('_display')[0]
-                field = getattr(self.__class__, field_name)
-
-                def new_func(field=field, field_name=field_name):
-                    value = getattr(self, field_name)
-                    for a, b in field.choices.items():
-                        if a == value:
-                            return b
+    def __init__(self, **kwargs):
+        self.validate_kwargs(kwargs)
 
-                setattr(self, k, new_func)
+        self.__dict__.update(self._field_defaults)
+        self.__dict__.update(kwargs)
 
-        self.validate_kwargs(kwargs)
+    @classmethod
+    def _from_db(cls):
+        # the instances loaded from the database, the values come from the records unvalidated
+        instance = cls.__new__(cls)
+        instance.__dict__.update(cls._field_defaults)
+        return instance
 
-        for field_name in self.fields.keys():
-            if hasattr(getattr(self.__class__, field_name), 'default'):
-                setattr(
-                    self,
-                    field_name,
-                    kwargs.get(field_name, getattr(self.__class__, field_name).default)
-                )
-            else:
-                setattr(self, field_name, None)
+    @classmethod
+    def compact_class(cls):
+        '''the slotted version of the model, generated the first time it is needed'''
+        compact = cls.__dict__.get('_compact_class')
+        if compact is None:
+            compact = compact_class(cls)
+            cls._compact_class = compact
+        return compact
 
     @classmethod
     def cls_tablename(cls):
@@ -113,33 +253,43 @@ class BaseModel(object, metaclass=ModelMeta):
 
             return model.objects.filter(**{field_name: getattr(self, self.orm_pk)})
 
-        setattr(cls, '{}_set'.format(model_name.lower()), fk_set)
+        accessor = '{}_set'.format(model_name.lower())
+        relation = {'kind': 'reverse', 'model': model_name, 'field': field_name}
+        setattr(cls, accessor, related_set(accessor, fk_set, relation))
 
     @classmethod
-    def set_many2many(cls, field, table_name, my_column, other_column,
+    def set_many2many(cls, field, table_name, my_column, other_column, other_model_name,
                       direct=False):
-        other_model = get_model(other_column)
-        queryset = ModelManager(other_model, field=field)
-        queryset.set_orm(cls.objects.orm)
-        other_column_pk = "{}_{}".format(other_column, other_model.db_pk).lower()
+        # the columns of the through table are named after the tables, the model is looked up by name
+        other_model = get_model(other_model_name)
 
         def m2m_set(self):
-            queryset.query = [{
-                'action': 'db__select_m2m',
-                'select': '*',
-                'm2m_tablename': table_name,
-                'other_tablename': other_model.table_name,
-                'other_column_pk': other_column_pk,
-                'otherdb_pk': other_model.db_pk,
-                'id_data': '{}={}'.format(my_column, getattr(self, self.orm_pk)),
-            }]
+            queryset = other_model.objects.queryset()
+            queryset.query = queryset.query.add({
+                'action': 'db__where',
+                'condition': '{}.{} = ANY (SELECT {} FROM {} WHERE {} = $1)'.format(
+                    other_model.table_name or other_model.__name__.lower(),
+                    other_model.db_pk,
+                    other_column,
+                    table_name,
+                    my_column,
+                ),
+                'values': [getattr(self, self.orm_pk)],
+            })
             return queryset
 
         method_name = (
             direct and field.field_name or
-            '{}_set'.format(other_column.lower())
+            '{}_set'.format(other_model_name.lower())
         )
-        setattr(cls, method_name, m2m_set)
+        relation = {
+            'kind': 'many_to_many',
+            'model': other_model_name,
+            'table_name': table_name,
+            'my_column': my_column,
+            'other_column': other_column,
+        }
+        setattr(cls, method_name, related_set(method_name, m2m_set, relation))
 
     @classmethod
     def set_orm(cls, orm):
@@ -166,6 +316,39 @@ class BaseModel(object, metaclass=ModelMeta):
 
         return d
 
+    @property
+    def dirty_fields(self):
+        '''
+        The fields changed since the instance was loaded from the database or saved,
+        None when it never was, then all of them have to be saved
+        '''
+        columns = self._columns
+        if columns is None:
+            return None
+
+        dirty = []
+        for f_n, field in self.fields.items():
+            if f_n == self.orm_pk or isinstance(field, ManyToManyField):
+                continue
+
+            value = getattr(self, f_n)
+            if hasattr(value, 'orm_pk'):
+                # the related instance that came with select_related
+                value = getattr(value, value.orm_pk)
+
+            if f_n in columns:
+                position, recompose = columns[f_n]
+                original = self._record[position]
+                if recompose and original is not None:
+                    original = recompose(original)
+            else:
+                # not loaded, so it still has the default unless it was set
+                original = self._field_defaults[f_n]
+
+            if value != original:
+                dirty.append(f_n)
+        return dirty
+
     @property
     def m2m_data(self):
         d = {}
@@ -299,50 +482,101 @@ class BaseModel(object, metaclass=ModelMeta):
 
 class Model(BaseModel):
 
+    @classmethod
+    def column_decoders(cls, columns):
+        '''(position, attribute, recompose) for the (position, db column) of the model'''
+        db_names = {db: orm for orm, db in cls.attr_names.items()}
+        decoders = []
+        for position, column in columns:
+            orm = column if column in cls.attr_names else db_names.get(column, column)
+            field = cls.fields.get(orm)
+            decoders.append((position, orm, field and field.recompose_func))
+        return decoders
+
+    @classmethod
+    def row_decoder(cls, columns, subitems=(), lazy=False):
+        '''
+        Builds the function that populates an instance from the records with those columns
+        the positions, attribute names, recompose and related models are resolved here once
+        When lazy the (compact) instances keep the record and decode each field when read
+        '''
+        plain, joined = [], {}
+        for position, column in enumerate(columns):
+            if column.startswith('_'):
+                # columns added by the statement itself (_created...), no db_column starts with '_'
+                continue
+            # the joined columns are aliased <join alias>__<position in the join columns>
+            alias, _, index = column.partition('__')
+            if index:
+                joined.setdefault(alias, []).append((position, int(index)))
+            else:
+                plain.append((position, column))
+
+        plain = cls.column_decoders(plain)
+        # (alias, parent alias, attribute, model, pk position, decoders) parents before children
+        joins, aliases = [], {}
+        for subitem in subitems:
+            for join in subitem.get('fields', ()):
+                aliases[join['path']] = join['alias']
+                if join['alias'] not in joined:
+                    continue
+
+                parent_path, _, attr_name = join['path'].rpartition('__')
+                model = cls
+                for name in join['path'].split('__'):
+                    model = get_model(getattr(model, name).foreign_key)
+
+                join_columns = [(position, join['columns'][i]) for position, i in joined[join['alias']]]
+                pk_position = None
+                for position, column in join_columns:
+                    if column == model.db_pk:
+                        pk_position = position
+                joins.append((
+                    join['alias'], aliases.get(parent_path), attr_name, model, pk_position,
+                    model.column_decoders(join_columns),
+                ))
+
+        column_map = {name: (position, recompose) for position, name, recompose in plain}
+
+        def decode(record, instance):
+            # the record is kept, it is also the snapshot to know what changed on save
+            instance._record = record
+            instance._columns = column_map
+            if not lazy:
+                for position, name, recompose in plain:
+                    setattr(instance, name, decoded(record[position], recompose))
+
+            related_objects = {None: instance}
+            for alias, parent_alias, name, model, pk_position, columns in joins:
+                parent = related_objects.get(parent_alias)
+                # nothing joined when the foreign key is null
+                if parent is None or pk_position is None or record[pk_position] is None:
+                    continue
+                related = model._from_db()
+                for position, related_name, recompose in columns:
+                    value = record[position]
+                    setattr(related, related_name, recompose(value) if recompose else value)
+                related.deleted = False
+                setattr(parent, name, related)
+                related_objects[alias] = related
+
+            instance.deleted = False
+            return instance
+        return decode
+
     def construct(self, data, deleted=False, subitems=None):
-        # populates the model with the data
-        internal_objects = {}
+        # populates the model with the data, the related ones come decoded by the row decoders
         for k, v in data.items():
-            k_splitted = k.split('€$$€')
-            if len(k_splitted) == 1:
-                # check if its named different in the database than the orm
-                if k not in self.__class__.attr_names.keys():
-                    for orm, db in self.__class__.attr_names.items():
-                        if k == db:
-                            k = orm
-                            break
-                # get the recomposed value
-                field_class = getattr(self.__class__, k)
-                v = field_class.recompose(v)
-
-                if field_class in [ForeignKey, ManyToManyField]:
-                    pass
-                setattr(self, k, v)
-            else:
-                # itself or empty dict
-                internal_objects[k_splitted[0]] = internal_objects.get(k_splitted[0], {})
-
-                # update the new value
-                internal_objects[k_splitted[0]].update({k_splitted[1]: v})
-
-        if internal_objects:
-            for attr_name, data in internal_objects.items():
-                if hasattr(self, attr_name):
-                    if getattr(self, attr_name):
-                        field = getattr(self.__class__, attr_name)
-                        model = get_model(field.foreign_key)
-
-                        setattr(self, attr_name, model().construct(data))
-                else:
-                    for subitem in subitems:
-                        if "fields" not in subitem:
-                            continue
-                        for join in subitem["fields"]:
-                            if join['right_table'] == attr_name:
-                                field = getattr(self.__class__, join['orm_fieldname'])
-                                model = get_model(field.foreign_key)
-                                setattr(self, join['orm_fieldname'], model().construct(data))
-                                break
+            # check if its named different in the database than the orm
+            if k not in self.__class__.attr_names.keys():
+                for orm, db in self.__class__.attr_names.items():
+                    if k == db:
+                        k = orm
+                        break
+            # get the recomposed value
+            field_class = getattr(self.__class__, k)
+            v = field_class.recompose(v)
+            setattr(self, k, v)
 
         self.deleted = deleted
         return self
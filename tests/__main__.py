@@ -13,7 +13,8 @@ loop = orm_app.loop
 
 drop_tables = [
     'Publisher', 'Author', 'library', 'Organization', 'Developer', 'Client',
-    'Developer_Organization', 'Author_Publisher', 'Appointment', 'Reader', 'Skill'
+    'Developer_Organization', 'Author_Publisher', 'Appointment', 'Reader', 'Skill', 'Contract',
+    'shelves_Publisher', 'shelves',
 ]
 
 
@@ -27,31 +28,13 @@ for table_name in drop_tables:
 
 orm_app.sync_db()
 
-
-async def create_book(x):
-    book = Book(**{
-        'name': 'book name {}'.format(str(x)),
-        'content': 'hard cover',
-    })
-
-    await book.save()
-
-
-async def create_author(x):
-    author = Author(**{
-        'name': 'foo_boy {}'.format(str(x)),
-        'age': 23,
-    })
-
-    await author.save()
-
 # create some test models
-for x in range(3):
-    task = loop.create_task(create_author(x))
-    loop.run_until_complete(asyncio.gather(task))
-for x in range(300):
-    task = loop.create_task(create_book(x))
-    loop.run_until_complete(asyncio.gather(task))
+loop.run_until_complete(Author.objects.bulk_create([
+    Author(name='foo_boy {}'.format(x), age=23) for x in range(3)
+], returning=True))
+loop.run_until_complete(Book.objects.bulk_create([
+    Book(name='book name {}'.format(x), content='hard cover') for x in range(300)
+]))
 
 
 if __name__ == '__main__':
@@ -72,6 +72,13 @@ class FieldTests(AioTestCase):
 
         self.assertEqual(book.content_display(), 'hard cover book')
 
+    async def test_choices_display_loaded(self):
+        book = await Book.objects.get(id=1)
+
+        # the display is a method of the class, not created for each instance
+        self.assertNotIn('content_display', book.__dict__)
+        self.assertEqual(book.content_display(), 'hard cover book')
+
     async def test_choices_content_not_in_choices(self):
         # choices defined as lists or tuples
         with self.assertRaises(FieldError) as exc:
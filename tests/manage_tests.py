@@ -1,14 +1,23 @@
+import asyncio
+from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
+from decimal import Decimal
+import tracemalloc
 
+from asyncorm.database import PostgresManager
 from asyncorm.exceptions import (
     ModelError, ModelDoesNotExist, QuerysetError, MultipleObjectsReturned
 )
+from asyncorm.manager.managers import Queryset, decode_token, encode_token
+from asyncorm.models import Avg, Count, Max, RowNumber, Sum, Window
 
 from tests.testapp.models import Author, Book
-from tests.testapp2.models import Appointment, Developer, Client
+from tests.testapp2.models import Appointment, Contract, Developer, Client, Organization, Skill
 from tests.test_helper import AioTestCase
 
+Config = namedtuple('Config', ['statement_cache_size', 'max_cacheable_statement_size'])
+
 
 class ManageTestMethods(AioTestCase):
 
@@ -85,6 +94,19 @@ class ManageTestMethods(AioTestCase):
 
         self.assertEqual(await queryset.count(), 100)
 
+    async def test_count_estimate(self):
+        db_manager = Organization.objects.db_manager
+        await Organization.objects.bulk_create([Organization(name='estimated') for _ in range(20)])
+
+        # the statistics of the table, small tables are fully sampled
+        await db_manager.execute(('ANALYZE organization', []))
+        self.assertEqual(await Organization.objects.count(estimate=True), await Organization.objects.count())
+
+        # the planner estimate for the filtered ones, exact when it is under the threshold
+        queryset = Book.objects.filter(id__lte=100)
+        self.assertIsInstance(await queryset.count(estimate=True), int)
+        self.assertEqual(await queryset.count(estimate=True, threshold=10 ** 9), 100)
+
     async def test_filter_changed_fieldname(self):
         author = await Author.objects.filter(na__lt=5)[0]
 
@@ -122,7 +144,33 @@ class ManageTestMethods(AioTestCase):
 
         book = await queryset[0]
 
-        self.assertNotEqual(book.id, 24 - 5)
+        # the index is relative to the slice
+        self.assertEqual(book.id, 24 - 5)
+
+    async def test_slice_limit_offset(self):
+        queryset = await Book.objects.filter(id__lt=25)[5:10]
+
+        query = Book.objects.db_manager.construct_query(queryset.query)
+        self.assertIn('LIMIT 5 OFFSET 5', query[0])
+
+        ids = []
+        async for book in queryset:
+            ids.append(book.id)
+        self.assertEqual(ids, [19, 18, 17, 16, 15])
+
+    async def test_slice_of_slice(self):
+        queryset = await Book.objects.filter(id__lt=25)[5:15]
+        queryset = await queryset[2:20]
+
+        ids = []
+        async for book in queryset:
+            ids.append(book.id)
+        self.assertEqual(ids, [17, 16, 15, 14, 13, 12, 11, 10])
+
+    async def test_slice_count(self):
+        queryset = await Book.objects.filter(id__lt=25)[20:]
+
+        self.assertEqual(await queryset.count(), 4)
 
     async def test_slice_wrong_slice(self):
         with self.assertRaises(QuerysetError) as exc:
@@ -373,6 +421,77 @@ class ManageTestMethods(AioTestCase):
         self.assertIsInstance(book, Book)
         self.assertFalse(created)
 
+    async def test_get_or_create_single_statement(self):
+        stats = dict(Developer.objects.db_manager.statement_stats)
+        dev, created = await Developer.objects.get_or_create(name='upserted developer', defaults={'age': 40})
+        self.assertTrue(created)
+        self.assertEqual((dev.name, dev.age), ('upserted developer', 40))
+        self.assertTrue(dev.id)
+
+        same, created = await Developer.objects.get_or_create(name='upserted developer', defaults={'age': 50})
+        self.assertFalse(created)
+        self.assertEqual((same.id, same.age), (dev.id, 40))
+        lookups = Developer.objects.db_manager.statement_stats
+        self.assertEqual(lookups['hits'] + lookups['misses'], stats['hits'] + stats['misses'] + 2)
+
+    async def test_get_or_create_concurrent(self):
+        results = await asyncio.gather(*[
+            Developer.objects.get_or_create(name='concurrent developer') for _ in range(5)
+        ])
+
+        self.assertEqual(len({dev.id for dev, _ in results}), 1)
+        self.assertEqual([created for _, created in results].count(True), 1)
+
+    async def test_update_or_create(self):
+        dev, created = await Developer.objects.update_or_create(name='updated developer', defaults={'age': 41})
+        self.assertTrue(created)
+
+        same, created = await Developer.objects.update_or_create(name='updated developer', defaults={'age': 42})
+        self.assertFalse(created)
+        self.assertEqual((same.id, same.age), (dev.id, 42))
+        self.assertEqual((await Developer.objects.get(id=dev.id)).age, 42)
+        self.assertEqual(same.dirty_fields, [])
+
+    async def test_update_or_create_without_unique(self):
+        # nothing unique in the lookup: looked up and then saved
+        dev, created = await Developer.objects.update_or_create(age=77, defaults={'name': 'aged developer'})
+        self.assertTrue(created)
+
+        same, created = await Developer.objects.update_or_create(age=77, defaults={'name': 'old developer'})
+        self.assertFalse(created)
+        self.assertEqual(same.id, dev.id)
+        self.assertEqual((await Developer.objects.get(id=dev.id)).name, 'old developer')
+
+    async def test_bulk_upsert(self):
+        existing = await Developer.objects.create(name='upsert 0', age=20)
+        devs = [Developer(name='upsert {}'.format(i), age=30 + i) for i in range(3)]
+
+        await Developer.objects.bulk_upsert(devs, conflict_fields=['name'], update_fields=['age'])
+        self.assertEqual(devs[0].id, existing.id)
+        self.assertTrue(all(d.id for d in devs))
+
+        ages = []
+        async for age in Developer.objects.filter(name__startswith='upsert ').order_by('name').values_list(
+                'age', flat=True):
+            ages.append(age)
+        self.assertEqual(ages, [30, 31, 32])
+
+        # without update fields the conflicting ones are skipped
+        more = [Developer(name='upsert 1', age=99), Developer(name='upsert 3', age=33)]
+        await Developer.objects.bulk_upsert(more, conflict_fields=['name'])
+        self.assertIsNone(more[0].id)
+        self.assertTrue(more[1].id)
+        self.assertEqual((await Developer.objects.get(name='upsert 1')).age, 31)
+
+    async def test_bulk_upsert_errors(self):
+        with self.assertRaises(QuerysetError):
+            await Developer.objects.bulk_upsert([Developer(name='upsert error')], conflict_fields=[])
+        with self.assertRaises(QuerysetError):
+            await Developer.objects.bulk_upsert([Developer(name='upsert error')], conflict_fields=['org'])
+        with self.assertRaises(QuerysetError):
+            # not a unique constraint
+            await Developer.objects.bulk_upsert([Developer(name='upsert error')], conflict_fields=['age'])
+
     async def test_only_with_filter(self):
         q_books = Book.objects.filter(
             name__startswith='book name 10').only('name')
@@ -397,6 +516,191 @@ class ManageTestMethods(AioTestCase):
 
         self.assertEqual(total_price, quant * 25)
 
+    async def test_aggregate(self):
+        q_books = Book.objects.filter(id__lt=100)
+        stats = Book.objects.db_manager.statement_stats
+        before = stats['hits'] + stats['misses']
+
+        result = await q_books.aggregate(
+            total=Sum('price'),
+            n=Count('*'),
+            top=Max('price'),
+            avgPrice=Avg('price'),
+            first_ones=Count('id', filter={'id__lte': 10}),
+            first_total=Sum('price', filter={'id__lte': 10, 'name__startswith': 'book'}),
+        )
+        self.assertEqual(stats['hits'] + stats['misses'], before + 1)
+
+        self.assertEqual(result['n'], await q_books.count())
+        self.assertEqual(result['total'], await q_books.Sum('price'))
+        self.assertEqual(result['top'], await q_books.Max('price'))
+        self.assertEqual(result['avgPrice'], await q_books.Avg('price'))
+        self.assertEqual(result['first_ones'], 10)
+        self.assertEqual(result['first_total'], 250)
+
+        # over the slice, and without the joins
+        sliced = await Book.objects.select_related('author').order_by('id')[:5]
+        self.assertEqual(await sliced.aggregate(n=Count('*'), last=Max('id')), {'n': 5, 'last': 5})
+
+    async def test_aggregate_errors(self):
+        with self.assertRaises(QuerysetError):
+            await Book.objects.aggregate()
+        with self.assertRaises(QuerysetError):
+            await Book.objects.aggregate(total=Sum('name'))
+        with self.assertRaises(QuerysetError):
+            await Book.objects.aggregate(total=Sum('*'))
+        with self.assertRaises(QuerysetError):
+            await Book.objects.aggregate(_total=Sum('price'))
+        with self.assertRaises(QuerysetError):
+            await Book.objects.aggregate(total='SUM(price)')
+
+    async def test_annotate_group_by(self):
+        devs = await Developer.objects.bulk_create(
+            [Developer(name='grouped developer {}'.format(i)) for i in range(3)], returning=True)
+        clients = []
+        for i, dev in enumerate(devs):
+            clients.extend([Client(name='grp {} {}'.format(i, n), dev=dev.id) for n in range(i + 1)])
+        await Client.objects.bulk_create(clients)
+        queryset = Client.objects.filter(name__startswith='grp ')
+
+        groups = queryset.values('dev').annotate(n=Count('id')).filter(n__gt=1).order_by('-n')
+        sql, _ = Client.objects.db_manager.construct_query(groups.query)
+        self.assertIn('GROUP BY', sql)
+        self.assertIn('HAVING', sql)
+
+        results = []
+        async for row in groups:
+            results.append(row)
+        self.assertEqual(results, [{'dev': devs[2].id, 'n': 3}, {'dev': devs[1].id, 'n': 2}])
+        self.assertEqual(await groups.count(), 2)
+        self.assertEqual(await (await groups.order_by('-n')[:1]).count(), 1)
+        self.assertTrue(await groups.exists())
+        self.assertFalse(await groups.filter(n__gt=3).exists())
+
+        # conditional aggregates, in the select and in the having
+        rows = []
+        grouped = queryset.group_by('dev').annotate(
+            firsts=Count('id', filter={'name__endswith': ' 0'}), total=Count('*'),
+        ).filter(total__range=(2, 3), firsts=1).order_by('dev')
+        async for row in grouped.iterator():
+            rows.append((row['dev'], row['firsts'], row['total']))
+        self.assertEqual(rows, [(devs[1].id, 1, 2), (devs[2].id, 1, 3)])
+
+        # named tuples, and each instance is a group without values
+        row = await queryset.filter(dev=devs[0].id).values_list('dev', named=True).annotate(n=Count('id'))[0]
+        self.assertEqual((row.dev, row.n), (devs[0].id, 1))
+        async for client in queryset.annotate(n=Count('id')):
+            self.assertIsInstance(client, Client)
+            self.assertEqual(client.n, 1)
+
+        # the groups without aggregates
+        self.assertEqual(await queryset.group_by('dev').count(), 3)
+
+        # unordered, the first group is the one of the lowest grouped columns
+        first = await queryset.values('dev').annotate(n=Count('id')).first()
+        self.assertEqual(first, {'dev': devs[0].id, 'n': 1})
+
+    def test_annotate_errors(self):
+        with self.assertRaises(QuerysetError):
+            Client.objects.annotate()
+        with self.assertRaises(QuerysetError):
+            Client.objects.annotate(name=Count('id'))
+        with self.assertRaises(QuerysetError):
+            Client.objects.annotate(n=Count('id')).values('dev')
+        with self.assertRaises(QuerysetError):
+            Client.objects.annotate(n=Count('id')).compact()
+        with self.assertRaises(QuerysetError):
+            Client.objects.values('dev').annotate(n=Count('id')).filter(n__contains=1)
+        with self.assertRaises(QuerysetError):
+            Client.objects.annotate(rank=Window(RowNumber(), partition_by='unknown'))
+
+    async def test_annotated_not_modified(self):
+        dev = await Developer.objects.create(name='kept developer')
+        await Client.objects.bulk_create([Client(name='kept {}'.format(i), dev=dev.id) for i in range(3)])
+        queryset = Client.objects.filter(name__startswith='kept ')
+
+        modified = [
+            queryset.values('dev').annotate(n=Count('id')).filter(n__isnull=True),
+            queryset.group_by('dev'),
+            queryset.annotate(rank=Window(RowNumber(), partition_by='dev')).filter(rank__gt=1),
+        ]
+        for grouped in modified:
+            with self.assertRaises(QuerysetError):
+                await grouped.delete()
+            with self.assertRaises(QuerysetError):
+                await grouped.update(name='changed')
+        self.assertEqual(await queryset.count(), 3)
+
+    async def test_annotate_window(self):
+        devs = await Developer.objects.bulk_create(
+            [Developer(name='windowed developer {}'.format(i)) for i in range(3)], returning=True)
+        clients = []
+        for i, dev in enumerate(devs):
+            clients.extend([Client(name='win {} {}'.format(i, n), dev=dev.id) for n in range(i + 2)])
+        await Client.objects.bulk_create(clients)
+        queryset = Client.objects.filter(name__startswith='win ')
+
+        # the two last clients of each developer, the rows are not grouped
+        ranked = queryset.annotate(rank=Window(RowNumber(), partition_by='dev', order_by='-id'))
+        sql, _ = Client.objects.db_manager.construct_query(ranked.query)
+        self.assertIn('OVER (PARTITION BY', sql)
+        self.assertNotIn('GROUP BY', sql)
+
+        top = ranked.filter(rank__lte=2).order_by('name')
+        names = []
+        async for client in top:
+            self.assertIsInstance(client, Client)
+            names.append((client.name, client.rank))
+        self.assertEqual(names, [
+            ('win 0 0', 2), ('win 0 1', 1), ('win 1 1', 2), ('win 1 2', 1), ('win 2 2', 2), ('win 2 3', 1),
+        ])
+        self.assertEqual(await top.count(), 6)
+        self.assertEqual(await (await top[4:]).count(), 2)
+        self.assertTrue(await top.filter(dev=devs[2].id).exists())
+        self.assertFalse(await ranked.filter(rank__gt=4).exists())
+
+        # aggregates over the partition, along the values
+        rows = []
+        totals = queryset.values('name').annotate(n=Window(Count('*'), partition_by='dev')).order_by('name')
+        async for row in totals.filter(n=2):
+            rows.append(row)
+        self.assertEqual(rows, [{'name': 'win 0 0', 'n': 2}, {'name': 'win 0 1', 'n': 2}])
+
+        # the values of the windows are kept when the select is replaced
+        firsts = queryset.annotate(
+            c=Window(Count('*', filter={'name__endswith': ' 0'}), partition_by='dev')).filter(c__gt=0)
+        self.assertEqual(await firsts.count(), 9)
+        self.assertTrue(await firsts.exists())
+        self.assertEqual(await firsts.Max('id'), await queryset.Max('id'))
+        self.assertEqual(
+            await firsts.aggregate(n=Count('*', filter={'name__endswith': ' 1'})), {'n': 3})
+
+    async def test_page(self):
+        await Organization.objects.bulk_create([Organization(name='paged {}'.format(i)) for i in range(7)])
+        queryset = Organization.objects.filter(name__startswith='paged ').order_by('name')
+
+        stats = Organization.objects.db_manager.statement_stats
+        statements = stats['hits'] + stats['misses']
+        results, total = await queryset.page(2, 3)
+        self.assertEqual(stats['hits'] + stats['misses'], statements + 1)
+        self.assertEqual([o.name for o in results], ['paged 3', 'paged 4', 'paged 5'])
+        self.assertEqual(total, 7)
+
+        results, total = await queryset.page(3, 3)
+        self.assertEqual(([o.name for o in results], total), (['paged 6'], 7))
+        self.assertEqual(await queryset.page(4, 3), ([], 7))
+        results, total = await queryset.page(1, 3, with_total=False)
+        self.assertEqual(([o.name for o in results], total), (['paged 0', 'paged 1', 'paged 2'], None))
+
+        # the total column is not part of the values
+        names, total = await queryset.values_list('name', flat=True).page(1, 2)
+        self.assertEqual((names, total), (['paged 0', 'paged 1'], 7))
+
+        with self.assertRaises(QuerysetError):
+            await queryset.page(0, 3)
+        with self.assertRaises(QuerysetError):
+            await queryset.page(1, 0)
+
     async def test_max(self):
         await Book.objects.create(
             **{'name': 'chancleta 2',
@@ -443,6 +747,32 @@ class ManageTestMethods(AioTestCase):
 
         self.assertFalse(resp)
 
+    async def test_exists_sliced(self):
+        books = Book.objects.filter(id__range=[10, 25])
+        self.assertTrue(await (await books[15:]).exists())
+        self.assertFalse(await (await books[16:]).exists())
+
+    async def test_single_row_statements(self):
+        db_manager = Book.objects.db_manager
+        sql, values = db_manager.construct_query(Book.objects._get_queryset({'id': 34}).query)
+        self.assertIn('LIMIT 2', sql)
+        self.assertEqual(values, [34])
+
+        book = await Book.objects.values('id', 'name').get(id=34)
+        self.assertEqual(book['id'], 34)
+
+    async def test_first(self):
+        # the model ordering, or the primary key
+        book = await Book.objects.first()
+        self.assertEqual(book.id, await Book.objects.Max('id'))
+
+        dev = await Developer.objects.first()
+        self.assertEqual(dev.id, (await Developer.objects.order_by('id')[0]).id)
+
+        book = await Book.objects.filter(id__range=[10, 25]).order_by('id').first()
+        self.assertEqual(book.id, 10)
+        self.assertIsNone(await Book.objects.filter(id=155625).first())
+
     def test_select_related_wrong_field(self):
         field_name = 'toto__noto'
         with self.assertRaises(QuerysetError) as exc:
@@ -544,6 +874,59 @@ class ManageTestMethods(AioTestCase):
         self.assertIsInstance(client.dev, Developer)
         self.assertIsInstance(client.appointment, Appointment)
 
+    async def test_select_related_same_columns(self):
+        signer = await Developer.objects.create(name='indexed signer')
+        witness = await Developer.objects.create(name='indexed witness')
+        client = await Client.objects.create(name='indexed', dev=signer.id)
+        contract = await Contract.objects.create(
+            name='indexed', client=client.id, signer=signer.id, witness=witness.id)
+        queryset = Contract.objects.filter(id=contract.id)
+
+        # both joins have the same columns, and so the same positional aliases
+        signed = await queryset.select_related('signer')[0]
+        witnessed = await queryset.select_related('witness')[0]
+        self.assertEqual(signed.signer.name, 'indexed signer')
+        self.assertEqual(witnessed.witness.name, 'indexed witness')
+        self.assertEqual(witnessed.signer, signer.id)
+
+    async def test_select_related_nested(self):
+        appointment = await Appointment.objects.create(name='nested', date=datetime.now())
+        dev = await Developer.objects.create(name='nested select developer')
+        client = await Client.objects.create(name='joined', dev=dev.id, appointment=appointment.id)
+        other = await Client.objects.create(name='joined 2', dev=dev.id)
+        contract = await Contract.objects.create(name='nested', client=client.id, signer=dev.id)
+        await Contract.objects.create(name='nested 2', client=other.id)
+
+        queryset = Contract.objects.select_related(
+            'client__dev', 'client__appointment', 'signer').filter(name__startswith='nested').order_by('name')
+        sql, _ = Contract.objects.db_manager.construct_query(queryset.query)
+        # each join once, with its positional alias
+        self.assertEqual(sql.count('LEFT JOIN'), 4)
+        self.assertNotIn('€', sql)
+
+        stats = Contract.objects.db_manager.statement_stats
+        before = stats['hits'] + stats['misses']
+        contracts = []
+        async for item in queryset:
+            contracts.append(item)
+        self.assertEqual(stats['hits'] + stats['misses'], before + 1)
+
+        self.assertEqual(contracts[0].id, contract.id)
+        self.assertIsInstance(contracts[0].client, Client)
+        self.assertIsInstance(contracts[0].client.dev, Developer)
+        self.assertEqual(contracts[0].client.dev.name, 'nested select developer')
+        self.assertEqual(contracts[0].client.appointment.id, appointment.id)
+        self.assertEqual(contracts[0].signer.id, dev.id)
+
+        # the null foreign keys stay None, at any level
+        self.assertIsNone(contracts[1].signer)
+        self.assertIsNone(contracts[1].client.appointment)
+        self.assertEqual(contracts[1].client.dev.id, dev.id)
+
+        # joining again what is already joined adds nothing
+        sql_again, _ = Contract.objects.db_manager.construct_query(queryset.select_related('client').query)
+        self.assertEqual(sql_again.count('LEFT JOIN'), 4)
+
     async def test_double_queryset(self):
         q_books = Book.objects.filter(id__gt=220).order_by('id')
         q_books_excluded = q_books.exclude(id__range=(200, 250)).order_by('id')
@@ -553,3 +936,595 @@ class ManageTestMethods(AioTestCase):
 
         self.assertEqual(book_a.id, 221)
         self.assertEqual(book_b.id, 251)
+
+    async def test_iteration_single_connection(self):
+        queryset = Book.objects.filter(id__lte=100)
+
+        count = 0
+        async for book in queryset:
+            count += 1
+
+        # every page came from the same cursor, that already gave back its connection
+        self.assertEqual(count, 100)
+        self.assertIsNone(queryset._cursor._conn)
+
+    async def test_iteration_aclose(self):
+        queryset = Book.objects.all()
+
+        async for book in queryset:
+            break
+        self.assertIsNotNone(queryset._cursor._conn)
+
+        await queryset.aclose()
+        self.assertIsNone(queryset._cursor._conn)
+
+    async def test_iterator_adaptive_chunks(self):
+        queryset = Book.objects.filter(id__lte=200).iterator(chunk_size=10, max_chunk_size=80)
+
+        ids = []
+        async for book in queryset:
+            ids.append(book.id)
+
+        stats = queryset.fetch_stats
+        self.assertEqual(len(ids), 200)
+        self.assertEqual(len(set(ids)), 200)
+        self.assertEqual(stats['rows'], 200)
+        # 10 + 20 + 40 + 80 + 50, instead of 20 pages of 10 rows
+        self.assertEqual(stats['pages'], 5)
+        self.assertTrue(stats['bytes'] > 0)
+
+    async def test_iterator_no_prefetch(self):
+        queryset = Book.objects.filter(id__lte=50).iterator(chunk_size=20, prefetch=False, max_chunk_size=20)
+
+        count = 0
+        async for book in queryset:
+            count += 1
+
+        self.assertEqual(count, 50)
+        self.assertEqual(queryset.fetch_stats['pages'], 3)
+
+    async def test_iterator_chained(self):
+        # the chunk sizes are kept by the querysets chained after iterator()
+        queryset = Book.objects.iterator(chunk_size=20, prefetch=False, max_chunk_size=20).filter(id__lte=50)
+
+        count = 0
+        async for book in queryset:
+            count += 1
+
+        self.assertEqual(count, 50)
+        self.assertEqual(queryset.fetch_stats['pages'], 3)
+
+    def test_iterator_wrong_chunk_size(self):
+        with self.assertRaises(QuerysetError) as exc:
+            Book.objects.all().iterator(chunk_size=0)
+
+        self.assertEqual('chunk_size should be a positive integer', exc.exception.args[0])
+
+    async def test_paginate(self):
+        queryset = Book.objects.filter(id__lte=25)
+
+        books, token = await queryset.paginate(size=10)
+        self.assertEqual([b.id for b in books], list(range(25, 15, -1)))
+
+        books, token = await queryset.paginate(after=token, size=10)
+        self.assertEqual([b.id for b in books], list(range(15, 5, -1)))
+
+        books, token = await queryset.paginate(after=token, size=10)
+        self.assertEqual([b.id for b in books], list(range(5, 0, -1)))
+        self.assertIsNone(token)
+
+    async def test_paginate_multiple_columns(self):
+        queryset = Book.objects.filter(id__lte=25).order_by('name')
+
+        books, token = await queryset.paginate(size=3)
+        names = [b.name for b in books]
+        books, token = await queryset.paginate(after=token, size=3)
+        names += [b.name for b in books]
+
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(set(names)), 6)
+
+    async def test_paginate_values(self):
+        books, token = await Book.objects.filter(id__lte=25).values('id', 'name').paginate(size=3)
+        self.assertEqual([sorted(b) for b in books], [['id', 'name']] * 3)
+        self.assertEqual([b['id'] for b in books], [25, 24, 23])
+
+        await Developer.objects.bulk_create([Developer(name='returned {}'.format(i), age=i) for i in range(2)])
+        queryset = Developer.objects.filter(name__startswith='returned ').values('name')
+        updated = await queryset.update(age=40, returning=True)
+        self.assertEqual(sorted(updated, key=lambda d: d['name']), [{'name': 'returned 0'}, {'name': 'returned 1'}])
+        deleted = await queryset.values_list('name', flat=True).delete(returning=True)
+        self.assertEqual(sorted(deleted), ['returned 0', 'returned 1'])
+
+    async def test_paginate_selected_columns(self):
+        queryset = Book.objects.filter(id__lte=25)
+        names, token = [], None
+        for _ in range(2):
+            books, token = await queryset.only('name').paginate(after=token, size=10)
+            names += [b.name for b in books]
+        books, _ = await queryset.paginate(size=20)
+        self.assertEqual(names, [b.name for b in books])
+
+    async def test_paginate_wrong_ordering(self):
+        queryset = Client.objects.annotate(n=Count('id'))
+        with self.assertRaises(QuerysetError):
+            await queryset.order_by('n').paginate(size=3)
+        with self.assertRaises(QuerysetError):
+            await Client.objects.order_by('?').paginate(size=3)
+        with self.assertRaises(QuerysetError):
+            await Client.objects.group_by('dev').paginate(size=3)
+
+    async def test_paginate_mixed_ordering(self):
+        queryset = Book.objects.order_by('name', '-id')
+
+        with self.assertRaises(QuerysetError) as exc:
+            await queryset.paginate(size=3)
+
+        self.assertEqual(
+            'Keyset pagination requires all the ordering in the same direction', exc.exception.args[0])
+
+    async def test_paginate_wrong_token(self):
+        with self.assertRaises(QuerysetError) as exc:
+            await Book.objects.all().paginate(after='notatoken', size=3)
+
+        self.assertEqual('Not a correct pagination token', exc.exception.args[0])
+
+    def test_pagination_token_types(self):
+        values = [3, 'name', Decimal('25.00'), datetime(2018, 1, 2, 3, 4, 5, 6), None]
+
+        self.assertEqual(decode_token(encode_token(values)), values)
+
+    def test_filter_bind_parameters(self):
+        db_manager = Book.objects.db_manager
+
+        query_a = db_manager.construct_query(Book.objects.filter(id__gt=3).exclude(name='a').query)
+        query_b = db_manager.construct_query(Book.objects.filter(id__gt=7).exclude(name='b').query)
+
+        # the values travel apart so both querysets share the same statement
+        self.assertEqual(query_a[0], query_b[0])
+        self.assertIn('$2', query_a[0])
+        self.assertNotIn("'a'", query_a[0])
+        self.assertEqual(query_a[1], [3, 'a'])
+        self.assertEqual(query_b[1], [7, 'b'])
+
+    async def test_filter_bind_parameters_quotes(self):
+        queryset = Book.objects.filter(name="book name 1' OR '1'='1")
+
+        self.assertEqual(await queryset.count(), 0)
+
+    async def test_prepared_statement_cache(self):
+        db_manager = Book.objects.db_manager
+        before = db_manager.statement_cache_stats
+
+        for book_id in (10, 11, 12):
+            await Book.objects.filter(id=book_id)[0]
+
+        after = db_manager.statement_cache_stats
+        # the same shape is parsed once and reused for the rest of the values
+        self.assertTrue(after['hits'] - before['hits'] >= 2)
+        self.assertTrue(after['misses'] - before['misses'] <= 1)
+
+    def test_prepared_statement_warm_up(self):
+        queries = Book.objects.db_manager.warm_up_queries
+
+        # the lookup by primary key of every model, with a value to run it
+        self.assertIn(Book.objects.warm_up_queries()[0], queries)
+        self.assertIn(Author.objects.warm_up_queries()[0], queries)
+
+    async def test_prepared_statement_warm_up_runs(self):
+        db_manager = Book.objects.db_manager
+        # every connection is new to it
+        manager = PostgresManager(db_manager.pool)
+        manager.warm_up_queries = db_manager.warm_up_queries
+        query = Book.objects.warm_up_queries()[0][0]
+
+        async def prepared(conn):
+            records = await conn.fetch('SELECT statement FROM pg_prepared_statements')
+            return [r['statement'] for r in records]
+
+        async with db_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                # a failure would abort the transaction, it is not warmed up there
+                await manager.execute_query(conn, 'fetch', 'SELECT 1', [])
+            self.assertEqual(manager.statement_stats['misses'], 1)
+
+            await manager.execute_query(conn, 'fetch', 'SELECT 1', [])
+            self.assertIn(query, await prepared(conn))
+
+            hits = manager.statement_stats['hits']
+            await manager.execute_query(conn, 'fetch', query, [1])
+            self.assertEqual(manager.statement_stats['hits'], hits + 1)
+
+    async def test_prepared_statement_warm_up_public(self):
+        class Connection(object):
+            # only the public api, as the asyncpg versions without the private one
+            def __init__(self, conn):
+                self.conn, self.prepared = conn, []
+
+            def is_in_transaction(self):
+                return self.conn.is_in_transaction()
+
+            async def prepare(self, query):
+                self.prepared.append(query)
+                return await self.conn.prepare(query)
+
+        db_manager = Book.objects.db_manager
+        manager = PostgresManager(db_manager.pool)
+        manager.warm_up_queries = Book.objects.warm_up_queries()
+
+        async with db_manager.pool.acquire() as conn:
+            public = Connection(conn)
+            await manager.prepare(public, 'SELECT 1')
+        self.assertEqual(public.prepared, [Book.objects.warm_up_queries()[0][0]])
+
+    async def test_prepared_statement_cache_disabled(self):
+        class Connection(object):
+            # the settings of a connection created with statement_cache_size=0
+            _config = Config(statement_cache_size=0, max_cacheable_statement_size=0)
+
+            def is_in_transaction(self):
+                return True
+
+        manager = PostgresManager(None)
+        conn = Connection()
+        for _ in range(3):
+            await manager.prepare(conn, 'SELECT 1')
+        self.assertEqual(manager.statement_stats, {'hits': 0, 'misses': 3, 'evictions': 0})
+
+    def test_compiled_query_cache(self):
+        db_manager = Book.objects.db_manager
+        before = db_manager.compiled_cache_stats
+
+        queries = [
+            db_manager.construct_query(Book.objects.filter(id__gt=i).order_by('-id').query)
+            for i in range(3)
+        ]
+
+        after = db_manager.compiled_cache_stats
+        # compiled once, the rest only bind their values
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(len({q[0] for q in queries}), 1)
+        self.assertEqual([q[1] for q in queries], [[0], [1], [2]])
+        self.assertTrue(0 < after['hit_rate'] <= 1)
+
+    def test_compiled_query_cache_shapes(self):
+        db_manager = Book.objects.db_manager
+
+        query_a = db_manager.construct_query(Book.objects.filter(id__gt=3).order_by('id').query)
+        query_b = db_manager.construct_query(Book.objects.filter(id__gt=3).order_by('-id').query)
+        query_c = db_manager.construct_query(Book.objects.filter(id__lt=3).order_by('id').query)
+
+        self.assertNotEqual(query_a[0], query_b[0])
+        self.assertNotEqual(query_a[0], query_c[0])
+
+    def test_query_structural_sharing(self):
+        queryset = Book.objects.filter(id__gt=3)
+        excluded = queryset.exclude(name='a')
+        ordered = excluded.order_by('-id')
+
+        # the chained nodes are shared, not copied
+        self.assertIs(excluded.query.tail.parent, queryset.query.tail)
+        self.assertIs(ordered.query.tail, excluded.query.tail)
+        self.assertEqual(len(ordered.query), 3)
+
+        # and the original querysets are left untouched
+        self.assertEqual(len(queryset.query), 2)
+        self.assertEqual(excluded.query[0]['ordering'], Book.ordering)
+        self.assertEqual(ordered.query[0]['ordering'], ['-id'])
+        self.assertIs(Book.objects.basic_query, Book.objects.basic_query)
+
+    async def test_bulk_create_copy(self):
+        developers = [Developer(name='bulk copy {}'.format(x), age=30) for x in range(50)]
+
+        result = await Developer.objects.bulk_create(developers, batch_size=20)
+
+        self.assertIs(result, developers)
+        self.assertEqual(await Developer.objects.filter(name__startswith='bulk copy').count(), 50)
+        # without returning nothing comes back from the database
+        self.assertIsNone(developers[0].id)
+
+    async def test_bulk_create_returning(self):
+        developers = [Developer(name='bulk returning {}'.format(x)) for x in range(30)]
+
+        await Developer.objects.bulk_create(developers, batch_size=7, returning=True)
+
+        ids = [dev.id for dev in developers]
+        self.assertTrue(all(ids))
+        self.assertEqual(ids, sorted(ids))
+        dev = await Developer.objects.get(id=ids[3])
+        self.assertEqual(dev.name, 'bulk returning 3')
+        self.assertEqual(dev.age, 25)
+
+    async def test_bulk_create_errors(self):
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.bulk_create([Developer(name='bulk wrong')], batch_size=0)
+        self.assertEqual(exc.exception.args[0], 'batch_size should be a positive integer')
+
+        developers = [Developer(name='bulk repeated'), Developer(name='bulk repeated')]
+        with self.assertRaises(ModelError) as exc:
+            await Developer.objects.bulk_create(developers, returning=True)
+        self.assertEqual(exc.exception.args[0], 'The model violates a unique constraint')
+
+        # the whole insertion was rolled back
+        self.assertEqual(await Developer.objects.filter(name='bulk repeated').count(), 0)
+
+    async def test_bulk_update(self):
+        developers = [Developer(name='bulk update {}'.format(x), age=20) for x in range(25)]
+        await Developer.objects.bulk_create(developers, returning=True)
+
+        for dev in developers:
+            dev.age = dev.id % 50
+            dev.name = dev.name.replace('update', 'updated')
+
+        updated = await Developer.objects.bulk_update(developers, ['age', 'name'], batch_size=10)
+
+        self.assertEqual(updated, 25)
+        dev = await Developer.objects.get(id=developers[7].id)
+        self.assertEqual(dev.age, developers[7].id % 50)
+        self.assertEqual(dev.name, 'bulk updated 7')
+        self.assertEqual(await Developer.objects.filter(name__startswith='bulk update ').count(), 0)
+
+        # they are saved, only what changed afterwards is dirty
+        self.assertEqual(developers[7].dirty_fields, [])
+        developers[7].age += 1
+        self.assertEqual(developers[7].dirty_fields, ['age'])
+
+    async def test_bulk_update_to_null(self):
+        authors = [
+            await Author.objects.create(name='bulk nulled {}'.format(i), email='bulk@example.com', age=i)
+            for i in range(2)
+        ]
+        for author in authors:
+            author.email = None
+        self.assertEqual(await Author.objects.bulk_update(authors, ['email']), 2)
+        self.assertEqual(await Author.objects.filter(name__startswith='bulk nulled ', email__isnull=True).count(), 2)
+
+    async def test_bulk_update_errors(self):
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.bulk_update([], ['wrong'])
+        self.assertEqual(exc.exception.args[0], 'wrong is not a correct field for Developer')
+
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.bulk_update([], ['org'])
+        self.assertEqual(exc.exception.args[0], 'org field can not be bulk updated')
+
+        with self.assertRaises(ModelError) as exc:
+            await Developer.objects.bulk_update([Developer(name='bulk unsaved')], ['name'])
+        self.assertEqual(exc.exception.args[0], 'The Developer instances have to be saved before')
+
+    async def test_queryset_update(self):
+        await Developer.objects.bulk_create(
+            [Developer(name='set update {}'.format(x), age=x) for x in range(10)])
+        queryset = Developer.objects.filter(name__startswith='set update', age__gte=5)
+
+        updated = await queryset.update(age=99)
+
+        self.assertEqual(updated, 5)
+        self.assertEqual(await Developer.objects.filter(name__startswith='set update', age=99).count(), 5)
+
+        developers = await Developer.objects.filter(name='set update 1').update(returning=True, age=98)
+        self.assertEqual(len(developers), 1)
+        self.assertIsInstance(developers[0], Developer)
+        self.assertEqual(developers[0].age, 98)
+
+    async def test_queryset_update_errors(self):
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.filter(name='set update 1').update()
+        self.assertEqual(exc.exception.args[0], 'update requires the fields to update')
+
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.all().update(id=3)
+        self.assertEqual(exc.exception.args[0], 'id field can not be updated')
+
+        with self.assertRaises(QuerysetError) as exc:
+            await (await Developer.objects.all()[:3]).update(age=3)
+        self.assertEqual(exc.exception.args[0], 'Sliced querysets can not be updated or deleted')
+
+    async def test_manager_delete_requires_instance(self):
+        await Developer.objects.create(name='not deleted', age=1)
+        with self.assertRaises(QuerysetError):
+            await Developer.objects.delete()
+        with self.assertRaises(QuerysetError):
+            await Developer.objects.delete(None)
+        self.assertTrue(await Developer.objects.filter(name='not deleted').exists())
+
+    async def test_queryset_update_to_null(self):
+        await Author.objects.create(name='set nulled', email='nulled@example.com', age=3)
+        queryset = Author.objects.filter(name='set nulled')
+        self.assertEqual(await queryset.update(email=None), 1)
+        self.assertIsNone((await queryset.get()).email)
+
+    async def test_queryset_delete(self):
+        await Developer.objects.bulk_create(
+            [Developer(name='set delete {}'.format(x), age=x) for x in range(10)])
+
+        deleted = await Developer.objects.filter(name__startswith='set delete', age__lt=3).delete()
+        self.assertEqual(deleted, 3)
+
+        developers = await Developer.objects.filter(name__startswith='set delete').exclude(
+            age__lt=8).delete(returning=True)
+        self.assertEqual(sorted(dev.age for dev in developers), [8, 9])
+
+        self.assertEqual(await Developer.objects.filter(name__startswith='set delete').count(), 5)
+        self.assertEqual(await Developer.objects.none().delete(), 0)
+
+    async def test_values(self):
+        queryset = Book.objects.filter(id__lte=3).order_by('id').values('id', 'name')
+
+        rows = []
+        async for row in queryset:
+            rows.append(row)
+
+        self.assertEqual(rows[0], {'id': 1, 'name': 'book name 0'})
+        self.assertEqual(len(rows), 3)
+        # the projection goes to the database
+        query = Book.objects.db_manager.construct_query(queryset.query)
+        self.assertIn('SELECT library.id, library.name FROM', query[0])
+
+        # all the fields when none is requested, with the orm names
+        author = await Author.objects.filter(name='foo_boy 1').values()[0]
+        self.assertEqual(author['name'], 'foo_boy 1')
+        self.assertIn('na', author)
+        self.assertNotIn('publisher', author)
+
+    async def test_values_list(self):
+        queryset = Book.objects.filter(id__lte=3).order_by('id')
+
+        self.assertEqual(await queryset.values_list('id', 'content')[0], (1, 'hard cover'))
+        self.assertEqual(await queryset.values_list('name', flat=True)[2], 'book name 2')
+        self.assertEqual(await queryset.values_list('id', flat=True).count(), 3)
+
+        row = await queryset.values_list('id', 'name', named=True).get(id=2)
+        self.assertEqual((row.id, row.name), (2, 'book name 1'))
+
+    def test_values_list_errors(self):
+        with self.assertRaises(QuerysetError) as exc:
+            Book.objects.values_list('id', 'name', flat=True)
+        self.assertEqual(exc.exception.args[0], 'flat is only allowed with a single field')
+
+        with self.assertRaises(QuerysetError) as exc:
+            Book.objects.values_list('id', flat=True, named=True)
+        self.assertEqual(exc.exception.args[0], 'flat and named can not be used together')
+
+        with self.assertRaises(QuerysetError) as exc:
+            Author.objects.values('publisher')
+        self.assertEqual(exc.exception.args[0], 'publisher is not a correct field for Author')
+
+    async def test_row_decoder_cache(self):
+        decoders = Queryset.decoders
+        queryset = Author.objects.filter(age=23).order_by('name')
+
+        hits = decoders.stats['hits']
+        names = []
+        for _ in range(2):
+            async for author in queryset.all():
+                names.append(author.name)
+
+        # built once for the statement, then shared
+        self.assertEqual(decoders.stats['hits'] - hits, 1)
+        self.assertEqual(names[:3], ['foo_boy 0', 'foo_boy 1', 'foo_boy 2'])
+
+        # db columns named different than the attributes
+        author = await Author.objects.get(name='foo_boy 1')
+        self.assertTrue(author.na)
+        self.assertFalse(hasattr(author, 'uid'))
+
+    async def test_compact_instances(self):
+        book = await Book.objects.compact().get(id=3)
+
+        self.assertIsInstance(book, Book)
+        self.assertFalse(hasattr(book, '__dict__'))
+        self.assertEqual(book.name, 'book name 2')
+        self.assertEqual(book.content_display(), 'hard cover book')
+
+        # they can still be saved
+        book.quantity = 7
+        await book.save()
+        self.assertEqual((await Book.objects.get(id=3)).quantity, 7)
+        book.quantity = 1
+        await book.save()
+
+    async def test_compact_lazy_instances(self):
+        book = await Book.objects.compact(lazy=True).filter(id=4)[0]
+
+        # nothing is decoded until it is read
+        self.assertIsNotNone(book._record)
+        with self.assertRaises(AttributeError):
+            Book.compact_class()._slot_name.__get__(book)
+        self.assertEqual(book.name, 'book name 3')
+        self.assertEqual(Book.compact_class()._slot_name.__get__(book), 'book name 3')
+
+    async def test_compact_meta(self):
+        Book.compact = True
+        try:
+            book = await Book.objects.filter(id=5)[0]
+        finally:
+            Book.compact = False
+        self.assertIsInstance(book, Book.compact_class())
+
+    def test_compact_super(self):
+        class Overridden(Book):
+            async def save(self, **kwargs):
+                await super().save(**kwargs)
+
+        # the compact class is not a subclass of the model, super() could not work there
+        with self.assertRaises(ModelError):
+            Overridden.objects.compact()
+        with self.assertRaises(ModelError):
+            Overridden.compact_class()
+
+    async def test_compact_memory(self):
+        queryset = Book.objects.filter(id__lte=200)
+        records = await Book.objects.db_manager.fetch(
+            Book.objects.db_manager.construct_query(queryset.query))
+
+        def allocated(queryset):
+            tracemalloc.start()
+            try:
+                instances = [queryset.build_result(r) for r in records]
+                return tracemalloc.get_traced_memory()[0], instances
+            finally:
+                tracemalloc.stop()
+
+        querysets = [queryset.all(), queryset.compact(), queryset.compact(lazy=True)]
+        for built in querysets:
+            # the decoders are built once, they are not part of the instances
+            built.build_result(records[0])
+        (regular, _), (slots, _), (lazy, _) = [allocated(built) for built in querysets]
+
+        self.assertLess(slots, regular * 0.6)
+        self.assertLessEqual(lazy, slots)
+
+    async def test_save_only_dirty_fields(self):
+        dev = await Developer.objects.create(name='dirty developer', age=30)
+        dev = await Developer.objects.get(id=dev.id)
+        self.assertEqual(dev.dirty_fields, [])
+
+        # nothing changed, nothing is sent
+        stats = dict(Developer.objects.db_manager.statement_stats)
+        await dev.save()
+        self.assertEqual(Developer.objects.db_manager.statement_stats, stats)
+
+        # someone else changes the age meanwhile, only the name is updated
+        await Developer.objects.filter(id=dev.id).update(age=31)
+        dev.name = 'dirty developer renamed'
+        self.assertEqual(dev.dirty_fields, ['name'])
+        await dev.save()
+
+        dev = await Developer.objects.get(id=dev.id)
+        self.assertEqual((dev.name, dev.age), ('dirty developer renamed', 31))
+
+    async def test_save_dirty_fields_to_null(self):
+        author = await Author.objects.create(name='nulled author', email='nulled@example.com', age=40)
+        author = await Author.objects.get(na=author.na)
+        author.email = None
+        self.assertEqual(author.dirty_fields, ['email'])
+        await author.save()
+        self.assertIsNone((await Author.objects.get(na=author.na)).email)
+
+        dev = await Developer.objects.create(name='signer', age=30)
+        client = await Client.objects.create(name='nulled', dev=dev.id)
+        contract = await Contract.objects.create(name='nulled contract', client=client.id, signer=dev.id)
+        contract = await Contract.objects.get(id=contract.id)
+        contract.signer = None
+        await contract.save()
+        self.assertIsNone((await Contract.objects.get(id=contract.id)).signer)
+
+    async def test_dirty_fields_arrays(self):
+        dev = await Developer.objects.create(name='arrays', age=30)
+        skill = await Skill.objects.create(dev=dev.id, name='arrays', specialization=['backend'])
+        for lazy in (None, False, True):
+            queryset = lazy is None and Skill.objects or Skill.objects.compact(lazy=lazy)
+            loaded = await queryset.get(id=skill.id)
+            self.assertEqual(loaded.dirty_fields, [])
+
+        # changed in place
+        skill = await Skill.objects.get(id=skill.id)
+        skill.specialization.append('frontend')
+        self.assertEqual(skill.dirty_fields, ['specialization'])
+        await skill.save()
+        self.assertEqual((await Skill.objects.get(id=skill.id)).specialization, ['backend', 'frontend'])
+
+    def test_dirty_fields_not_loaded(self):
+        # the instances that never were in the database save everything
+        self.assertIsNone(Developer(name='dirty new').dirty_fields)
@@ -1,10 +1,18 @@
 from asyncorm.application.configure import get_model
-from asyncorm.exceptions import FieldError, ModelError
+from asyncorm.exceptions import FieldError, ModelError, QuerysetError
 
-from tests.testapp.models import Book, Author
+from tests.testapp.models import Book, Author, Publisher, Shelf
 from tests.testapp2.models import Developer, Client, Organization
 from tests.test_helper import AioTestCase
 
+
+async def collect(queryset):
+    items = []
+    async for item in queryset:
+        items.append(item)
+    return items
+
+
 # You can get the book by model_name
 Book2 = get_model('Book')
 # And get the author by module.model_name
@@ -22,6 +30,22 @@ class ModelTests(AioTestCase):
         self.assertEqual(Book().cls_tablename(), 'library')
         self.assertEqual(Author().cls_tablename(), 'Author')
 
+    def test_app_name_once_per_class(self):
+        book = Book(name='app name')
+
+        self.assertEqual(Book.app_name, 'testapp')
+        self.assertEqual(book.app_name, 'testapp')
+        self.assertNotIn('app_name', book.__dict__)
+
+    def test_from_db_skips_validation(self):
+        # the values loaded from the database are not validated again
+        book = Book._from_db()
+        book.content = 'not in the choices'
+
+        self.assertIsNone(book.id)
+        self.assertEqual(book.quantity, 1)
+        self.assertEqual(book.content, 'not in the choices')
+
     def test_get_fields(self):
         fields = Book.get_fields()
 
@@ -146,3 +170,126 @@ class ModelTests(AioTestCase):
         # and they are correct
         self.assertEqual(developer_set.id, dev.id)
         self.assertIn(organization_set.id, org_list)
+
+    async def test_m2m_save_keeps_the_relations_in_sync(self):
+        orgs = await Organization.objects.bulk_create(
+            [Organization(name='m2m sync') for _ in range(4)], returning=True)
+        org_ids = [org.id for org in orgs]
+
+        dev = Developer(name='m2m sync developer', org=org_ids[:3])
+        await dev.save()
+        self.assertEqual(await dev.organization_set().count(), 3)
+
+        # saving again does not duplicate the links, and the stale ones are removed
+        dev.org = org_ids[1:]
+        await dev.save()
+        queryset = dev.organization_set().order_by('id')
+        self.assertEqual([(await queryset[i]).id for i in range(3)], org_ids[1:])
+        self.assertEqual(await queryset.count(), 3)
+
+    async def test_m2m_add_remove_set(self):
+        orgs = await Organization.objects.bulk_create(
+            [Organization(name='m2m operations') for _ in range(5)], returning=True)
+        dev = await Developer.objects.create(name='m2m operations developer', org=orgs[0].id)
+
+        self.assertEqual(await Developer.objects.add_m2m(dev, 'org', orgs[:3]), 2)
+        # the ones already related are skipped
+        self.assertEqual(await Developer.objects.add_m2m(dev, 'org', [orgs[2].id, orgs[3].id]), 1)
+        self.assertEqual(await dev.organization_set().count(), 4)
+
+        self.assertEqual(await Developer.objects.remove_m2m(dev, 'org', [orgs[0], orgs[4]]), 1)
+        self.assertEqual(await dev.organization_set().count(), 3)
+
+        await Developer.objects.set_m2m(dev, 'org', [orgs[3].id, orgs[4].id])
+        self.assertEqual(dev.org, [orgs[3].id, orgs[4].id])
+        self.assertEqual(await dev.organization_set().count(), 2)
+        self.assertEqual(await orgs[4].developer_set().count(), 1)
+
+        with self.assertRaises(QuerysetError) as exc:
+            await Developer.objects.add_m2m(dev, 'name', [1])
+        self.assertEqual(exc.exception.args[0], 'name is not a ManyToManyField for Developer')
+
+    async def test_m2m_custom_table_name(self):
+        # the through table columns are named after the tables, the accessors after the models
+        publishers = await Publisher.objects.bulk_create(
+            [Publisher(name='shelved {}'.format(i), json={'shelf': i}) for i in range(2)], returning=True)
+        shelf = await Shelf.objects.create(name='custom table', publisher=[p.id for p in publishers])
+
+        self.assertEqual(await shelf.publisher_set().count(), 2)
+        self.assertEqual(await publishers[0].shelf_set().count(), 1)
+        shelves = await collect(Shelf.objects.filter(id=shelf.id).prefetch_related('publisher_set'))
+        self.assertEqual(len(shelves[0].publisher_set()._results), 2)
+
+    async def test_m2m_add_without_unique_constraint(self):
+        # the through tables created before they had the unique constraint
+        field = Developer.fields['org']
+        db_manager = Developer.objects.db_manager
+        constraint = await db_manager.request((
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass($1) AND contype = 'u'",
+            [field.table_name.lower()]))
+        await db_manager.execute(('ALTER TABLE {} DROP CONSTRAINT {}'.format(field.table_name, constraint[0]), []))
+        try:
+            org = await Organization.objects.create(name='m2m not unique')
+            dev = await Developer.objects.create(name='m2m not unique developer')
+            await Developer.objects.add_m2m(dev, 'org', [org.id])
+            self.assertEqual(await Developer.objects.add_m2m(dev, 'org', [org.id]), 0)
+            self.assertEqual(await dev.organization_set().count(), 1)
+        finally:
+            await db_manager.execute(('ALTER TABLE {} ADD CONSTRAINT {} UNIQUE ({}, {})'.format(
+                field.table_name, constraint[0], field.own_model, field.foreign_key), []))
+
+    async def test_prefetch_related(self):
+        orgs = await Organization.objects.bulk_create(
+            [Organization(name='prefetch') for _ in range(3)], returning=True)
+        devs = []
+        for i in range(3):
+            devs.append(await Developer.objects.create(
+                name='prefetch developer {}'.format(i), org=[o.id for o in orgs[:i]]))
+        await Client.objects.bulk_create(
+            [Client(name='pf {}'.format(i), dev=devs[i % 2].id) for i in range(4)])
+
+        stats = Developer.objects.db_manager.statement_stats
+        before = stats['hits'] + stats['misses']
+        queryset = Developer.objects.filter(name__startswith='prefetch developer').order_by('name')
+        results = []
+        async for dev in queryset.prefetch_related('client_set', 'org'):
+            results.append(dev)
+        # the developers, their clients and their organizations
+        self.assertEqual(stats['hits'] + stats['misses'], before + 3)
+
+        clients, organizations = [], []
+        for dev in results:
+            clients.append(sorted([c.name for c in await collect(dev.client_set())]))
+            organizations.append(sorted([o.id for o in await collect(dev.organization_set())]))
+        self.assertEqual(stats['hits'] + stats['misses'], before + 3)
+        self.assertEqual(clients, [['pf 0', 'pf 2'], ['pf 1', 'pf 3'], []])
+        self.assertEqual(organizations, [[], [orgs[0].id], [orgs[0].id, orgs[1].id]])
+
+        # chaining on the accessor queries the database again
+        self.assertEqual(await results[0].client_set().filter(name='pf 2').count(), 1)
+
+    async def test_prefetch_related_nested(self):
+        org = await Organization.objects.create(name='nested prefetch')
+        dev = await Developer.objects.create(name='nested prefetch developer', org=[org.id])
+        await Client.objects.create(name='nested', dev=dev.id)
+
+        org = await Organization.objects.prefetch_related('developer_set__client_set').get(id=org.id)
+        stats = Developer.objects.db_manager.statement_stats
+        before = stats['hits'] + stats['misses']
+        devs = await collect(org.developer_set())
+        self.assertEqual([d.id for d in devs], [dev.id])
+        self.assertEqual([c.name for c in await collect(devs[0].client_set())], ['nested'])
+        self.assertEqual(stats['hits'] + stats['misses'], before)
+
+        # the foreign keys become the related instances
+        client = await Client.objects.prefetch_related('dev__org').get(name='nested')
+        self.assertEqual(client.dev.id, dev.id)
+        self.assertEqual([o.id for o in await collect(client.dev.organization_set())], [org.id])
+
+    def test_prefetch_related_wrong_relation(self):
+        with self.assertRaises(QuerysetError) as exc:
+            Developer.objects.prefetch_related('name')
+        self.assertEqual(exc.exception.args[0], 'name is not a relation of Developer')
+
+        with self.assertRaises(QuerysetError):
+            Developer.objects.prefetch_related('client_set__wrong')
@@ -59,6 +59,14 @@ class Book(models.Model):
         unique_together = ['name', 'content']
 
 
+class Shelf(models.Model):
+    name = models.CharField(max_length=50)
+    publisher = models.ManyToManyField(foreign_key='Publisher')
+
+    class Meta():
+        table_name = 'shelves'
+
+
 class Reader(models.Model):
     name = models.CharField(max_length=15, default='pepito')
     size = models.CharField(choices=SIZE_CHOICES, max_length=2)
@@ -20,6 +20,13 @@ class Client(models.Model):
     appointment = models.ForeignKey(foreign_key='Appointment', null=True)
 
 
+class Contract(models.Model):
+    name = models.CharField(max_length=50)
+    client = models.ForeignKey(foreign_key='Client')
+    signer = models.ForeignKey(foreign_key='Developer', null=True)
+    witness = models.ForeignKey(foreign_key='Developer', null=True)
+
+
 class Appointment(models.Model):
     name = models.CharField(max_length=50)
     date = models.DateField()